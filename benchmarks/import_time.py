@@ -0,0 +1,46 @@
+"""
+Cold-start benchmark of importing KA-Search.
+
+Each statement is timed in a fresh python process. The "eager" statement imports every submodule
+and the jax backend, which is what "import kasearch" used to do, and is the baseline the lazy imports are compared to.
+
+    python benchmarks/import_time.py --repeats 5
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+
+statements = {
+    'import kasearch': "import kasearch",
+    'canonical_numbering': "from kasearch import canonical_numbering",
+    'SearchDB': "from kasearch import SearchDB",
+    'SearchDB + numpy backend': "from kasearch import SearchDB; import kasearch.numpy_identity",
+    'eager (previous behaviour)': (
+        "import kasearch.prepare_OASdb, kasearch.prepare_db, kasearch.kasearch, kasearch.easy_search, "
+        "kasearch.meta_extract, kasearch.jax_identity"
+    ),
+}
+
+
+def time_statement(statement, repeats):
+    code = f"import time; t = time.perf_counter(); {statement}; print(time.perf_counter() - t)"
+
+    timings = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True)
+        if output.returncode != 0:
+            return None
+        timings.append(float(output.stdout.strip().splitlines()[-1]))
+
+    return statistics.median(timings)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    for name, statement in statements.items():
+        timing = time_statement(statement, args.repeats)
+        print(f"{name:<30}", "failed (missing dependency?)" if timing is None else f"{timing * 1000:8.1f} ms")
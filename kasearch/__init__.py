@@ -1,7 +1,31 @@
-from kasearch.align_sequences import AlignSequences
-from kasearch.prepare_db import PrepareDB
-from kasearch.prepare_OASdb import PrepareOASdb, prepare_tiny_oas
-from kasearch.kasearch import SearchDB
-from kasearch.easy_search import EasySearch
-from kasearch.meta_extract import ExtractMetadata
-from kasearch.canonical_alignment import canonical_numbering
\ No newline at end of file
+import importlib
+
+# Submodules are only imported when their content is first used, so e.g. 
+# "from kasearch import canonical_numbering" does not import jax, pandas or anarci.
+_lazy_imports = {
+    'AlignSequences': 'kasearch.align_sequences',
+    'AlignmentCache': 'kasearch.alignment_cache',
+    'PrepareDB': 'kasearch.prepare_db',
+    'PrepareOASdb': 'kasearch.prepare_OASdb',
+    'prepare_tiny_oas': 'kasearch.prepare_OASdb',
+    'SearchDB': 'kasearch.kasearch',
+    'EasySearch': 'kasearch.easy_search',
+    'ExtractMetadata': 'kasearch.meta_extract',
+    'build_metadata_index': 'kasearch.meta_extract',
+    'canonical_numbering': 'kasearch.canonical_alignment',
+    'convert_database': 'kasearch.shard_io',
+}
+
+__all__ = list(_lazy_imports)
+
+
+def __getattr__(name):
+    if name in _lazy_imports:
+        value = getattr(importlib.import_module(_lazy_imports[name]), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
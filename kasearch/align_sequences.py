@@ -1,57 +1,91 @@
-from multiprocessing import Pool
+from multiprocessing import Pool, shared_memory, resource_tracker
 
 import numpy as np
 
+from kasearch.alignment_cache import AlignmentCache, cached_alignments
 from kasearch.anarci_numbering import number_many_at_once
-from kasearch.canonical_alignment import canonical_alignment, canonical_alignment_oas, canonical_numbering_len
+from kasearch.canonical_alignment import canonical_alignment, canonical_alignment_oas_many, canonical_numbering_len
 
 class AlignSequences:
     """
-    Canonical alignment of sequences for KA-Search.  
+    Canonical alignment of sequences for KA-Search.
+
+    With n_jobs > 1, the sequences are numbered and aligned by a pool of processes, which is started on the first
+    call and reused by later calls until close() is called (or the aligner is used as a context manager).
+
+    With a cache (an AlignmentCache or the path to its file), sequences which have been aligned before are not numbered again.
     """
-    
-    def __init__(self, allowed_species=['Human', 'Mouse'], n_jobs=1, from_oas=False, strict=True, fast_implementation=False):
-        
+
+    def __init__(self, allowed_species=['Human', 'Mouse'], n_jobs=1, from_oas=False, strict=True, fast_implementation=False, cache=None):
+
         self._from_oas = from_oas
         self._fast_implementation= fast_implementation
         self.strict = strict
         self.n_jobs = n_jobs
-        self._unusual_sequence = np.zeros(canonical_numbering_len, np.int8)
-        
+        self._pool = None
+        self._owns_cache = isinstance(cache, str)
+        self.cache = AlignmentCache(cache) if self._owns_cache else cache
+
         if allowed_species:
             self.allowed_species = [i.lower() for i in allowed_species]
         else:
             self.allowed_species = None
-        
-    def _canonical_alignment(self, numbered_seq):
-        """Canonical alignment of ANARCI numberings.
-        
-        Parameters
-        ----------
-        seq : dict
-            Either OAS derived ANARCI numberings or nested ANARCI numberings
 
-        Returns
-        -------
-        numpy array
-            Canonical alignment of a single sequence
+    def close(self):
+        """
+        Shut down the processes used for aligning sequences, and the cache if it was opened from a path.
+        """
+
+        if self._owns_cache: self.cache.close()
+
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _parallel_alignment(self, seqs):
         """
-        
+        Align chunks of sequences in the pool of processes, which write the alignments directly into shared memory.
+        """
+
+        if self._pool is None:
+            # The processes share the resource tracker of this process, which removes the shared output if it is leaked
+            resource_tracker.ensure_running()
+            self._pool = Pool(processes=self.n_jobs)
+
+        n_seqs = len(seqs)
+        chunk_size = min(10_000, -(-n_seqs // self.n_jobs))
+
+        output = shared_memory.SharedMemory(create=True, size=max(1, n_seqs * canonical_numbering_len))
         try:
-            if self._from_oas:
-                return canonical_alignment_oas(numbered_seq)
-            else:
-                return canonical_alignment(numbered_seq)
-        except Exception:
-            
-            if self.strict:
-                raise ValueError(f"At least one sequence cannot be aligned with the canonical alignment.")
-            else:
-                return self._unusual_sequence
-            
+            tasks = [
+                (output.name, n_seqs, start, seqs[start:start+chunk_size], self._from_oas, self.allowed_species, self.strict)
+                for start in range(0, n_seqs, chunk_size)
+            ]
+            failed = np.concatenate(self._pool.map(_align_into_shared, tasks, chunksize=1))
+            alignments = np.ndarray((n_seqs, canonical_numbering_len), np.int8, buffer=output.buf).copy()
+        finally:
+            output.close()
+            output.unlink()
+
+        return alignments, failed
+
+    def _align(self, seqs):
+
+        if self.n_jobs == 1 or len(seqs) < 2:
+            return _align(seqs, self._from_oas, self.allowed_species, self.strict)
+        else:
+            return self._parallel_alignment(seqs)
+
     def _many_canonical_alignment(self, seqs):
         """Canonical alignment of many sequences.
-        
+
         Parameters
         ----------
         seqs : list
@@ -62,25 +96,60 @@ class AlignSequences:
         numpy array
             Canonical alignments of many sequences
         """
-        
-        if self._from_oas:
-            numbered_seqs = seqs
-        else:
-            numbered_seqs = number_many_at_once(seqs, allowed_species=self.allowed_species, strict=self.strict, ncpu=self.n_jobs)
-        
-        
-        if self.n_jobs == 1:
-            return np.array([self._canonical_alignment(numbered_seq) for numbered_seq in numbered_seqs])
+
+        seqs = list(seqs)
+
+        if self.cache is not None and not self._from_oas:
+            alignments, failed = cached_alignments(self.cache, seqs, self._align, self.allowed_species)
         else:
-            n_jobs = min(len(numbered_seqs), self.n_jobs)
-            chunksize = len(numbered_seqs) // n_jobs
+            alignments, failed = self._align(seqs)
+
+        if self.strict and failed.any():
+            raise ValueError(f"At least one sequence cannot be aligned with the canonical alignment.")
+
+        return alignments
 
-            with Pool(processes=n_jobs) as pool:
-                return np.array(pool.map(self._canonical_alignment, numbered_seqs, chunksize=chunksize))
-        
     def __call__(self, seqs):
-        
+
         if isinstance(seqs, str): seqs = [seqs]
-        
+
         return self._many_canonical_alignment(seqs)
 
+
+def _align(seqs, from_oas, allowed_species, strict):
+    """
+    Canonical alignments of sequences (or OAS numberings), and whether each of them failed. Failed sequences are all gaps.
+    """
+
+    if from_oas: # OAS numberings are all parsed together, which is faster than parsing them one at a time
+        return canonical_alignment_oas_many(seqs)
+
+    numbered_seqs = number_many_at_once(seqs, allowed_species=allowed_species, strict=strict)
+
+    alignments = np.zeros((len(numbered_seqs), canonical_numbering_len), np.int8)
+    failed = np.zeros(len(numbered_seqs), bool)
+
+    for num, numbered_seq in enumerate(numbered_seqs):
+        try:
+            alignments[num] = canonical_alignment(numbered_seq)
+        except Exception:
+            alignments[num], failed[num] = 0, True
+
+    return alignments, failed
+
+
+def _align_into_shared(task):
+    """
+    Align a chunk of sequences into its rows of the shared output array, returning which sequences failed.
+    """
+
+    output_name, n_seqs, start, seqs, from_oas, allowed_species, strict = task
+    alignments, failed = _align(seqs, from_oas, allowed_species, strict)
+
+    output = shared_memory.SharedMemory(name=output_name)
+    try:
+        np.ndarray((n_seqs, canonical_numbering_len), np.int8, buffer=output.buf)[start:start+len(seqs)] = alignments
+    finally:
+        output.close()
+
+    return failed
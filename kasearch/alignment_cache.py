@@ -0,0 +1,168 @@
+import hashlib
+import sqlite3
+import threading
+
+import numpy as np
+
+from kasearch.canonical_alignment import canonical_numbering_len
+from kasearch.lru_cache import LRUCache
+
+
+class AlignmentCache:
+    """
+    Cache of canonical alignments of sequences, so repeated sequences are not numbered with ANARCI again.
+
+    Alignments are keyed by a hash of the sequence and the settings used to number it (allowed species and scheme).
+    They are stored in a sqlite database on disk, which persists between sessions, and the most recently used
+    alignments are also kept in memory. Without a cache file, alignments are only kept in memory.
+
+    ...
+
+    Attributes
+    ----------
+    cache_file : str, None
+        Path to the sqlite database storing the alignments
+    stats : dict
+        Number of alignments found in memory, on disk and not found
+
+    Methods
+    -------
+    key(sequence, allowed_species, scheme)
+        Return the key of a sequence numbered with the given settings
+    get_many(keys)
+        Return the cached alignments of the keys found in the cache
+    put_many(alignments)
+        Add alignments to the cache
+    """
+
+    def __init__(self, cache_file=None, max_memory=100_000):
+
+        self.cache_file = cache_file
+        self._memory = LRUCache(max_size=max_memory)
+        self._lock = threading.Lock()
+        self.memory_hits, self.disk_hits, self.misses = 0, 0, 0
+
+        self._connection = None
+        if cache_file is not None:
+            self._connection = sqlite3.connect(cache_file, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS alignments (key TEXT PRIMARY KEY, alignment BLOB, failed INTEGER)"
+            )
+            self._connection.commit()
+
+    @staticmethod
+    def key(sequence, allowed_species=None, scheme='imgt'):
+
+        species = ','.join(sorted(allowed_species)) if allowed_species else 'any'
+        return hashlib.sha256(f"{scheme}\0{species}\0{sequence}".encode()).hexdigest()
+
+    def get_many(self, keys):
+        """Cached alignments of keys.
+
+        Parameters
+        ----------
+        keys : list of str
+            Keys of the sequences (see key)
+
+        Returns
+        -------
+        dict
+            The alignment and whether the alignment failed, for each key in the cache
+        """
+
+        found = {}
+        for key in keys:
+            value = self._memory.get(key)
+            if value is not None: found[key] = value
+
+        missing = list({key for key in keys if key not in found})
+        from_disk = {}
+
+        if missing and self._connection is not None:
+            with self._lock:
+                for start in range(0, len(missing), 500):  # sqlite limits the number of parameters of a query
+                    batch = missing[start:start+500]
+                    rows = self._connection.execute(
+                        f"SELECT key, alignment, failed FROM alignments WHERE key IN ({','.join('?' * len(batch))})", batch
+                    )
+                    for key, alignment, failed in rows:
+                        from_disk[key] = (np.frombuffer(alignment, np.int8).copy(), bool(failed))
+
+            for key, value in from_disk.items(): self._memory.put(key, value)
+            found.update(from_disk)
+
+        with self._lock:
+            self.disk_hits += len(from_disk)
+            self.misses += len(missing) - len(from_disk)
+            self.memory_hits += len(set(keys)) - len(missing)
+
+        return found
+
+    def put_many(self, alignments):
+        """Add alignments to the cache.
+
+        Parameters
+        ----------
+        alignments : dict
+            The alignment (of length canonical_numbering_len) and whether the alignment failed, for each key
+        """
+
+        for key, (alignment, failed) in alignments.items():
+            self._memory.put(key, (np.asarray(alignment, np.int8), bool(failed)))
+
+        if self._connection is None: return
+
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO alignments (key, alignment, failed) VALUES (?, ?, ?)",
+                [(key, np.asarray(alignment, np.int8).tobytes(), int(failed)) for key, (alignment, failed) in alignments.items()]
+            )
+            self._connection.commit()
+
+    def close(self):
+
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    @property
+    def stats(self):
+        return {'memory_hits': self.memory_hits, 'disk_hits': self.disk_hits, 'misses': self.misses}
+
+
+def cached_alignments(cache, seqs, align, allowed_species=None, scheme='imgt'):
+    """Canonical alignments of sequences, only aligning the sequences not found in the cache.
+
+    Parameters
+    ----------
+    cache : AlignmentCache
+        Cache of alignments
+    seqs : list
+        List of antibody sequences
+    align : callable
+        Function aligning a list of sequences, returning their alignments and whether each of them failed
+
+    Returns
+    -------
+    tuple of numpy arrays
+        Canonical alignments of the sequences and whether each of them failed
+    """
+
+    keys = [cache.key(seq, allowed_species, scheme) for seq in seqs]
+    found = cache.get_many(keys)
+
+    missing = {key: seq for key, seq in zip(keys, seqs) if key not in found}  # Repeated sequences are only aligned once
+    if missing:
+        new_alignments, new_failed = align(list(missing.values()))
+        aligned = {key: (alignment, failed) for key, alignment, failed in zip(missing, new_alignments, new_failed)}
+
+        cache.put_many(aligned)
+        found.update(aligned)
+
+    alignments = np.zeros((len(keys), canonical_numbering_len), np.int8)
+    failed = np.zeros(len(keys), bool)
+    for num, key in enumerate(keys):
+        alignments[num], failed[num] = found[key]
+
+    return alignments, failed
@@ -1,8 +1,10 @@
-from anarci import anarci
 from multiprocessing import Pool
 from functools import partial
+from itertools import chain
 
 def _number_chunk(sequences, scheme="imgt", database="ALL", allow=set(["H","K","L"]), allowed_species=['human','mouse'], strict = True, **kwargs):
+    from anarci import anarci # Imported here, as importing anarci is slow and only needed for numbering
+    
     try:
         numbered, _, _ = anarci(list(enumerate(sequences)), scheme=scheme, database=database, allow=allow, allowed_species=allowed_species, **kwargs)
         numbered  = [x[0][0] if x else None for x in numbered]
@@ -42,10 +44,10 @@ def number_many_at_once(
     number_chunk = partial(_number_chunk, scheme=scheme, database=database, allow=allow, allowed_species=allowed_species, strict=strict, **kwargs)
 
     if ncpu==1:
-        numbered = sum([number_chunk(sequences[i:i+chunk_size]) for i in range(0, len(sequences), chunk_size)], [])
+        numbered = list(chain.from_iterable(number_chunk(sequences[i:i+chunk_size]) for i in range(0, len(sequences), chunk_size)))
     else:
         with Pool(ncpu) as pool:
-            numbered = sum(pool.map(number_chunk, [sequences[i:i+chunk_size] for i in range(0, len(sequences), chunk_size)], chunksize=1), [])
+            numbered = list(chain.from_iterable(pool.map(number_chunk, [sequences[i:i+chunk_size] for i in range(0, len(sequences), chunk_size)], chunksize=1)))
     
     return numbered
             
@@ -157,4 +157,110 @@ def canonical_alignment_oas(anarci_output):
     sequence[(sequence == 45)] = 0
     sequence[:canonical_numbering_to_index[first_res]] = 124
     sequence[canonical_numbering_to_index[last_res] + 1:] = 124
-    return sequence
\ No newline at end of file
+    return sequence
+
+# Canonical position of each (number, insertion character) of a position, e.g. (111, 'A'), with -1 for other positions
+_canonical_position_table = np.full((1000, 256), -1, np.int64)
+for _index, _number in enumerate(canonical_numbering):
+    _canonical_position_table[int(_number[:-1]), ord(_number[-1])] = _index
+
+
+def _find_oas_numbering_tokens(text):
+    """
+    Finds the same tokens as oas_numbering_finder in an ascii encoded text (a numpy array), returning 
+    the start of each token together with the canonical position and the residue it describes.
+    """
+    
+    padded = np.concatenate([text, np.zeros(6, np.uint8)])
+    is_digit = lambda positions: (padded[positions] >= 48) & (padded[positions] <= 57)
+    
+    # A token is a run of digits, any character (but a line break) and "': '" followed by a residue (A-Z). 
+    # The run of digits is as long as possible, so the token ends at the last such residue following the run
+    ends = np.flatnonzero(text == 58) - 3
+    ends = ends[ends >= 0]
+    token = np.lib.stride_tricks.sliding_window_view(padded, 7)[ends]
+    ends = ends[
+        (token[:, 0] >= 48) & (token[:, 0] <= 57) & (token[:, 1] != 10) & (token[:, 2] == 39) & (token[:, 4] == 32) 
+        & (token[:, 5] == 39) & (token[:, 6] >= 65) & (token[:, 6] <= 90)
+    ]
+    
+    starts = ends.copy()
+    extend = starts > 0
+    while extend.any():
+        extend[extend] = is_digit(starts[extend] - 1)
+        starts[extend] -= 1
+        extend &= starts > 0
+    
+    last_in_run = np.append(starts[1:] != starts[:-1], True)
+    starts, ends = starts[last_in_run], ends[last_in_run]
+    
+    # Number of the position, which only gives a canonical position for up to three digits without leading zeros
+    n_digits = ends - starts + 1
+    number = np.zeros(starts.shape[0], np.int64)
+    for digit in range(3):
+        has_digit = digit < n_digits
+        number = np.where(has_digit, number * 10 + padded[np.minimum(starts + digit, text.shape[0])] - 48, number)
+    
+    canonical = (n_digits <= 3) & ((text[starts] != 48) | (n_digits == 1))
+    positions = np.where(canonical, _canonical_position_table[np.minimum(number, 999), padded[ends + 1]], -1)
+    
+    return starts, positions, padded[ends + 6].astype(np.int8)
+
+
+def canonical_alignment_oas_many(anarci_outputs):
+    """Canonical alignment of many OAS derived ANARCI numberings at once.
+    
+    Gives the same alignments as canonical_alignment_oas, but parses all numberings together.
+    
+    Parameters
+    ----------
+    anarci_outputs : list
+        OAS derived ANARCI numberings of the sequences
+
+    Returns
+    -------
+    numpy array, numpy array
+        Canonical alignments of the sequences, and whether each sequence could not be aligned (its alignment is then all zeros)
+    """
+    
+    n_sequences = len(anarci_outputs)
+    sequences = np.zeros((n_sequences, canonical_numbering_len), np.int8)
+    failed = np.array([not isinstance(output, str) for output in anarci_outputs], dtype=bool)
+    
+    # Numberings are parsed as one text, with a line break between each. Numberings containing line breaks 
+    # or other than ascii characters are aligned one by one.
+    separate = [num for num, output in enumerate(anarci_outputs) if not failed[num] and ('\n' in output or not output.isascii())]
+    is_separate = np.zeros(n_sequences, bool)
+    is_separate[separate] = True
+    
+    text = '\n'.join(output if not (failed[num] or is_separate[num]) else '' for num, output in enumerate(anarci_outputs))
+    text = np.frombuffer(text.encode('ascii'), np.uint8)
+    
+    starts, positions, residues = _find_oas_numbering_tokens(text)
+    rows = np.searchsorted(np.flatnonzero(text == 10), starts)
+    
+    failed[rows[positions < 0]] = True # Numberings with positions outside the canonical alignment
+    failed[np.setdiff1d(np.arange(n_sequences), rows)] = True # Numberings without residues (or aligned one by one)
+    
+    # Later residues at the same position replace earlier ones
+    keep = ~failed[rows]
+    rows, positions, residues = rows[keep], positions[keep], residues[keep]
+    _, last_at_position = np.unique((rows * canonical_numbering_len + positions)[::-1], return_index=True)
+    last_at_position = rows.shape[0] - 1 - last_at_position
+    sequences[rows[last_at_position], positions[last_at_position]] = residues[last_at_position]
+    
+    # Positions before the first and after the last residue (in the order of the numbering) are outside the sequence
+    aligned, first_residue = np.unique(rows, return_index=True)
+    last_residue = rows.shape[0] - 1 - np.unique(rows[::-1], return_index=True)[1]
+    
+    columns = np.arange(canonical_numbering_len)
+    outside = (columns < positions[first_residue][:, None]) | (columns > positions[last_residue][:, None])
+    sequences[aligned] = np.where(outside, 124, sequences[aligned])
+    
+    for num in separate:
+        try:
+            sequences[num], failed[num] = canonical_alignment_oas(anarci_outputs[num]), False
+        except Exception:
+            pass
+    
+    return sequences, failed
@@ -1,4 +1,9 @@
-from kasearch import AlignSequences, SearchDB
+from kasearch.align_sequences import AlignSequences
+from kasearch.alignment_cache import AlignmentCache
+from kasearch.kasearch import SearchDB
+
+# Queries aligned by EasySearch are cached for the session, unless a cache file is given
+_session_alignment_cache = AlignmentCache()
 
 
 def EasySearch(query, 
@@ -11,6 +16,7 @@ def EasySearch(query,
                include_ends=True,
                local_oas_path = None,
                n_jobs=1,
+               alignment_cache=None,
               ):
     """Quick KA-Search wrapper to run of a single query across a single region. 
 
@@ -32,6 +38,9 @@ def EasySearch(query,
         A flag for whether the identity will only be calculated between regions of identical length (default is [False])
     n_jobs : int
         Number of threads used (default is 1)
+    alignment_cache : str
+        Path to a file caching the canonical alignment of queries between sessions, so repeated queries are not 
+        numbered with ANARCI again (default is None, only caching them for the session)
 
     Returns
     -------
@@ -39,9 +48,12 @@ def EasySearch(query,
         A pandas dataframe with the keep_best_n closest sequences, and their meta data, to the query
     """
     
-    querydb = AlignSequences(n_jobs=n_jobs)(query)
+    cache = alignment_cache if alignment_cache is not None else _session_alignment_cache
+    
+    with AlignSequences(n_jobs=n_jobs, cache=cache) as align:
+        querydb = align(query)
     
-    targetdb = SearchDB(
+    with SearchDB(
         database_path = database_path,
         allowed_chain = allowed_chain, 
         allowed_species = allowed_species, 
@@ -49,8 +61,7 @@ def EasySearch(query,
         length_matched = length_matched,
         include_ends = include_ends,
         local_oas_path = local_oas_path,
-    )
-    
-    targetdb.search(querydb[:1], keep_best_n=keep_best_n)
+    ) as targetdb:
+        targetdb.search(querydb[:1], keep_best_n=keep_best_n)
 
-    return targetdb.get_meta(n_query=0, n_region=0, n_sequences='all', n_jobs=n_jobs)
\ No newline at end of file
+        return targetdb.get_meta(n_query=0, n_region=0, n_sequences='all', n_jobs=n_jobs)
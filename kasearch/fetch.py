@@ -0,0 +1,190 @@
+import os
+import re
+import glob
+import hashlib
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class RequestsTransport:
+    """
+    Downloads files over HTTP(S), reusing connections (keep-alive) between downloads.
+
+    Any object with a download(url, file) method can be used as a transport by StudyFetcher,
+    e.g. to fetch from a local stand-in of a server.
+    """
+
+    def __init__(self, pool_size=8, timeout=60, chunk_size=1 << 20):
+
+        self.timeout, self.chunk_size = timeout, chunk_size
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def download(self, url, file):
+
+        with self.session.get(url, stream=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+            with open(file, 'wb') as handle:
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    handle.write(chunk)
+
+    def close(self):
+        self.session.close()
+
+
+def is_url(file):
+    return file.startswith('http://') or file.startswith('https://')
+
+
+class StudyFetcher:
+    """
+    Local mirror of remote study files, keeping the most recently used files within a size limit.
+
+    ...
+
+    Attributes
+    ----------
+    cache_folder : str
+        Folder the downloaded files are stored in
+    max_size : int, None
+        Maximum total size in bytes of the downloaded files, or None for no limit
+    stats : dict
+        Number of downloads, hits and evicted files
+
+    Methods
+    -------
+    fetch(url)
+        Return the path to a local copy of url, downloading it if it is not already downloaded
+    fetched(url)
+        Context manager giving the path to a local copy of url, which is not evicted until the context exits
+    """
+
+    # Files written by the fetcher (see _cache_file), the only files which are evicted from cache_folder
+    _cache_file_pattern = re.compile(r'[0-9a-f]{16}-.+')
+
+    def __init__(self, cache_folder, max_size=5_000_000_000, transport=None, max_concurrent=4):
+
+        self.cache_folder, self.max_size = cache_folder, max_size
+        self.transport = transport if transport is not None else RequestsTransport(pool_size=max_concurrent)
+
+        self._downloads = threading.BoundedSemaphore(max_concurrent)
+        self._url_locks = {} # Lock of each url being fetched, with the number of threads using it
+        self._in_use = Counter() # Files being read, which are not evicted
+        self._lock = threading.Lock()
+        self.downloads, self.hits, self.evictions = 0, 0, 0
+
+    def _cache_file(self, url):
+        # The file name is kept, so e.g. the compression of the file can be inferred from it
+        return os.path.join(self.cache_folder, f"{hashlib.sha1(url.encode()).hexdigest()[:16]}-{os.path.basename(url)}")
+
+    def fetch(self, url):
+        """Local copy of a remote file. 
+        
+        The file can be evicted by later fetches of other files, so use fetched to read it while other threads fetch files.
+
+        Parameters
+        ----------
+        url : str
+            Url of the file
+
+        Returns
+        -------
+        str
+            Path to the downloaded file
+        """
+
+        with self.fetched(url) as cache_file:
+            return cache_file
+
+    @contextmanager
+    def fetched(self, url):
+        """
+        Local copy of a remote file (see fetch), which is kept until the context exits.
+        """
+
+        cache_file = self._cache_file(url)
+
+        with self._lock: # Files are only evicted while holding the lock, so the file is kept from here on
+            self._in_use[cache_file] += 1
+
+        try:
+            with self._url_lock(url):  # Concurrent requests for the same file only download it once
+                found = os.path.exists(cache_file)
+                if found:
+                    os.utime(cache_file)  # Marks the file as recently used
+                    with self._lock: self.hits += 1
+                else:
+                    self._download(url, cache_file)
+
+            if not found: self._evict(keep=cache_file)
+            yield cache_file
+        finally:
+            with self._lock:
+                self._in_use[cache_file] -= 1
+                if self._in_use[cache_file] == 0: del self._in_use[cache_file]
+
+    @contextmanager
+    def _url_lock(self, url):
+        """
+        Hold the lock of a url, which is removed once no thread uses it.
+        """
+
+        with self._lock:
+            lock_and_users = self._url_locks.setdefault(url, [threading.Lock(), 0])
+            lock_and_users[1] += 1
+
+        try:
+            with lock_and_users[0]:
+                yield
+        finally:
+            with self._lock:
+                lock_and_users[1] -= 1
+                if lock_and_users[1] == 0: del self._url_locks[url]
+
+    def _download(self, url, cache_file):
+
+        with self._downloads:
+            os.makedirs(self.cache_folder, exist_ok=True)
+            tmp_file = f"{cache_file}.{threading.get_ident()}.tmp"
+            try:
+                self.transport.download(url, tmp_file)
+                os.replace(tmp_file, cache_file)
+            finally:
+                if os.path.exists(tmp_file): os.remove(tmp_file)
+
+        with self._lock: self.downloads += 1
+
+    def _evict(self, keep=None):
+        """
+        Remove the least recently used files until the downloaded files are within max_size. Only files written 
+        by the fetcher are removed, and not those being read.
+        """
+
+        if self.max_size is None: return
+
+        with self._lock:
+            files = [
+                file for file in glob.glob(os.path.join(self.cache_folder, '*')) 
+                if self._cache_file_pattern.fullmatch(os.path.basename(file)) and not file.endswith('.tmp') and os.path.isfile(file)
+            ]
+            files.sort(key=os.path.getmtime)
+
+            size = sum(os.path.getsize(file) for file in files)
+            for file in files:
+                if size <= self.max_size: break
+                if file == keep or file in self._in_use: continue
+
+                size -= os.path.getsize(file)
+                os.remove(file)
+                self.evictions += 1
+
+    @property
+    def stats(self):
+        return {'downloads': self.downloads, 'hits': self.hits, 'evictions': self.evictions}
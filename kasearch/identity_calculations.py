@@ -1,106 +1,192 @@
 import os
-from multiprocessing import cpu_count, Pool
+import importlib
+from multiprocessing import Pool
 
-# This has to be set before jax is imported, but we should think of a better way to set it
-os.environ["XLA_FLAGS"]= f"--xla_force_host_platform_device_count={max(cpu_count()-2, 1)}" 
-os.environ["JAX_PLATFORMS"]='cpu'
-
-import jax
-import jax.numpy as jnp
-jax.config.update("jax_platforms", "cpu")
-jax.config.update('jax_platform_name', 'cpu') # This will be deprecated 
-
-
-from functools import partial
 import numpy as np 
 from kasearch.canonical_alignment import all_cdrs_mask, cdr3_mask, reg_def
+from kasearch.packed_encoding import packable, unpack_numberings
 
 default_region_masks = np.stack([np.ones(200, dtype = np.uint8), all_cdrs_mask, cdr3_mask])
 default_length_matched = np.array([False,True,True], dtype = bool)
 
+# Backends calculating the n most identical targets. Backends given as a module name are only imported when 
+# first used, so e.g. jax is not imported unless the jax backend is used.
+identity_backends = {
+    'jax': 'kasearch.jax_identity',
+    'numpy': 'kasearch.numpy_identity',
+}
+default_backend = 'jax'
+
+# With exact ranking, identities are kept as integer keys, i.e. overlap/length as a fixed-point number with identity_key_bits 
+# fractional bits. The key is the correctly rounded float32 quotient of the integer counts, scaled by 2**identity_key_bits, 
+# which all backends calculate the same. Region lengths are at most 200, so different identities differ by at least 1/40000 
+# and always have different keys, while identical ones (e.g. 1/2 and 2/4) have identical keys. Keys of -1 mark sequences 
+# which were not found.
+identity_key_bits = 23
+
+
+def identity_keys(overlap, length, matched=True):
+    """
+    Fixed-point keys of the identities overlap/length. Regions without residues, or with different 
+    lengths when length matched (matched is False), have a key of zero.
+    """
+    
+    length = np.asarray(length)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        identities = np.asarray(overlap).astype(np.float32) / length.astype(np.float32)
+    
+    keys = np.rint(identities * np.float32(1 << identity_key_bits))
+    return np.where(matched & (length > 0), keys, 0).astype(np.int32)
 
-@partial(jax.jit, static_argnums=1)
-def chunk(array, chunks):
-    old_size = array.shape[0]
-    if old_size % chunks != 0:
-        chunk_size = old_size//chunks + 1
-        array = jnp.pad(array, ((0,chunks*(chunk_size) - old_size),(0,0)), constant_values=0)
-    else:
-        chunk_size = old_size//chunks
-    return array.reshape(chunks, chunk_size, array.shape[-1])
 
+def id_ranks(ids):
+    """
+    Rank of each id (file_id, line) when ordered by file_id and then line. Targets with the same identity key are 
+    ranked by these, so exact rankings do not depend on how the targets are stored or split.
+    """
+    
+    ids = np.asarray(ids).reshape(-1, 2)
+    ranks = np.empty(ids.shape[0], np.int64)
+    ranks[np.lexsort((ids[:, 1], ids[:, 0]))] = np.arange(ids.shape[0])
+    return ranks
 
-@jax.jit
-def _calculate_single_sequence_identity_average(abs1, abs2, masks, length_matched):
-    comparison = abs1 == abs2
 
-    mask1, mask2 = (abs1 != 0) & (abs1 != 124), (abs2 != 0) & (abs1 != 124)
-    overlapping_residues = comparison * mask1 * mask2
+def identities_from_keys(keys):
+    """
+    Identities (as float32) of fixed-point keys, keeping -1 for sequences which were not found.
+    """
+    
+    keys = np.asarray(keys)
+    return np.where(keys >= 0, keys.astype(np.float32) * np.float32(2.0 ** -identity_key_bits), np.float32(-1))
 
-    len1, len2 = mask1 @ masks, mask2 @ masks
-    region_overlap = overlapping_residues @ masks
-    identities = ((region_overlap / len1) + (region_overlap / len2)) * (~length_matched | (len1==len2)) / 2
-    return identities
 
+def keys_from_identities(identities):
+    """
+    Fixed-point keys of identities calculated as floats, i.e. the nearest key.
+    """
+    
+    identities = np.asarray(identities, np.float64)
+    return np.where(identities >= 0, np.round(identities * (1 << identity_key_bits)), -1).astype(np.int32)
 
-@jax.jit
-def _calculate_single_sequence_identity_with_ends(abs1, abs2, masks, length_matched):
-    comparison = abs1 == abs2
 
-    mask1, mask2 = (abs1 != 0) & (abs1 != 124), (abs2 != 0) & (abs2 != 124)    
-    overlapping_residues = comparison * mask1 * mask2
+def register_backend(name, backend):
+    """Register a backend for calculating the n most identical targets.
+    
+    Parameters
+    ----------
+    name : str
+        Name used to select the backend
+    backend : str, module or function
+        Module (or name of module) with a get_n_most_identical_multiquery function, or the function itself
+    """
+    
+    identity_backends[name] = backend
+    
 
-    length = (mask1 | mask2) @ masks
-    region_overlap = overlapping_residues @ masks
-    identities = (region_overlap / length) * (~length_matched | ((mask1 @ masks) == (mask2 @ masks)))
-    return identities
+def _load_backend(name=None):
+    
+    name = name if name is not None else default_backend
+    assert name in identity_backends, f"Unknown backend '{name}'. Available backends are {list(identity_backends)}."
+    
+    if isinstance(identity_backends[name], str): 
+        identity_backends[name] = importlib.import_module(identity_backends[name])
+        
+    return identity_backends[name]
+    
 
+def get_backend(name=None):
+    """Retrieve the get_n_most_identical_multiquery function of a backend.
+    
+    Parameters
+    ----------
+    name : str
+        Name of the backend (default is None, using default_backend)
+
+    Returns
+    -------
+    function
+        The backend's get_n_most_identical_multiquery
+    """
+    
+    backend = _load_backend(name)
+    return backend if callable(backend) else backend.get_n_most_identical_multiquery
 
-@jax.jit
-def _calculate_single_sequence_identity_without_ends(abs1, abs2, masks, length_matched):
-    comparison = abs1 == abs2
 
-    mask1, mask2 = abs1 != 0, abs2 != 0
-    not_missing1, not_missing2 = abs1 != 124, abs2 != 124
-    exists1, exists2 = mask1 * not_missing1, mask2 * not_missing2
+def configure_backend(name=None, **options):
+    """
+    Import and set up a backend before its first use, e.g. the number of devices used by jax (n_devices). 
+    Options are ignored by backends which cannot be configured.
+    """
     
-    overlapping_residues = comparison * exists1 * exists2
+    backend = _load_backend(name)
+    if hasattr(backend, 'configure'): backend.configure(**options)
+
 
-    length = (mask1 | mask2) * (not_missing1 * not_missing2) @ masks
-    region_overlap = overlapping_residues @ masks
-    identities = (region_overlap / length) * (~length_matched | ((exists1 @ masks) == (exists2 @ masks)))
-    return identities
+def compile_stats(name=None):
+    """
+    Number and duration of the compilations of a backend's kernels, or None for backends which are not compiled.
+    """
+    
+    backend = _load_backend(name)
+    return backend.compile_stats() if hasattr(backend, 'compile_stats') else None
 
 
-@jax.jit
-def _calculate_single_sequence_identity(abs1, abs2, masks, length_matched, include_ends):
-    out = jax.lax.cond(
-        include_ends, _calculate_single_sequence_identity_with_ends,
-        _calculate_single_sequence_identity_without_ends, abs1, abs2,
-        masks, length_matched)
-    return out
+def __getattr__(name):
+    # The jax kernels used to live in this module
+    if name.startswith('_calculate') or name in ['chunk', 'calculate_many_sequence_identities', 'calculate_seq_ids_multiquery', 'calculate_n_most_identical']:
+        return getattr(importlib.import_module('kasearch.jax_identity'), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
-@jax.jit
-def _calculate_chunked_sequence_identity(abs1, abs2, masks, length_matched, include_ends):
+def bucketed_size(size, precision=3):
+    """
+    Round a size up to one of a few sizes, so compiled kernels are reused for inputs of similar sizes.
+    
+    Sizes up to 2**precision are kept, while larger sizes are rounded up to one of 2**precision 
+    evenly spaced sizes between consecutive powers of two, i.e. by at most 1/2**precision.
+    """
     
-    outs = [_calculate_single_sequence_identity(abs1, ab2, masks, length_matched, include_ends) for ab2 in abs2]
+    if size <= 1 << precision: return size
     
-    return jax.lax.transpose(jnp.stack(outs, axis = 2),(0,2,1))
+    step = 1 << (size.bit_length() - 1 - precision)
+    return -(-size // step) * step
 
 
-calculate_many_sequence_identities = jax.pmap(_calculate_chunked_sequence_identity, in_axes=(0,None,None,None,None))
+def tile_targets(targets, n_devices, tile_size=4096, small_targets=1 << 18):
+    """
+    Split targets into an equal number of fixed-size tiles per device, padding the last tiles with empty sequences.
+    
+    The number of tiles is rounded up with bucketed_size, so targets of different sizes share few shapes. For targets 
+    of fewer than small_targets rows it is rounded up to a power of two instead, as padding small targets costs less 
+    than compiling kernels for more shapes (e.g. for the many small shards of databases bucketed by CDR3 length).
+    Returns the tiles together with the index of the first target on each device.
+    """
+    
+    n_tiles = -(-targets.shape[0] // (n_devices * tile_size))
+    n_tiles = 1 << max(n_tiles - 1, 0).bit_length() if targets.shape[0] < small_targets else bucketed_size(n_tiles)
+    
+    tiles = np.zeros((n_devices * n_tiles * tile_size, targets.shape[1]), targets.dtype)
+    tiles[:targets.shape[0]] = targets
+    
+    return tiles.reshape(n_devices, n_tiles, tile_size, -1), np.arange(n_devices, dtype=np.int32) * n_tiles * tile_size
 
 
-def calculate_seq_ids_multiquery(array_of_abs1, array_of_abs2, region_masks, length_matched, include_ends):
-    masks, length_matched, include_ends = jnp.array(region_masks.T), jnp.array(length_matched), jnp.array(include_ends)
+def query_blocks(queries, query_block_size=32):
+    """
+    Split queries into blocks of a fixed size, padding the last block with empty sequences.
     
-    abs1 = chunk(jax.lax.stop_gradient(array_of_abs1), jax.device_count())
-    abs2 = jax.lax.stop_gradient(array_of_abs2)
-
-    identities = np.array(calculate_many_sequence_identities(abs1, abs2, masks, length_matched, include_ends))
+    Fewer queries than query_block_size are padded to the nearest power of two instead, 
+    so only a few block sizes are ever compiled.
+    """
+    
+    n_queries = queries.shape[0]
+    block_size = min(query_block_size, 1 << max(n_queries - 1, 0).bit_length())
+    padded_size = -(-n_queries // block_size) * block_size
+    
+    padded_queries = np.zeros((padded_size, queries.shape[1]), queries.dtype)
+    padded_queries[:n_queries] = queries
     
-    return identities.reshape(-1, array_of_abs2.shape[0], len(region_masks))[:array_of_abs1.shape[0]]   
+    return padded_queries.reshape(-1, block_size, queries.shape[1])
 
 
 def get_n_most_identical_multiquery(
@@ -108,20 +194,59 @@ def get_n_most_identical_multiquery(
     region_masks=default_region_masks,
     length_matched=default_length_matched,
     include_ends=True,
+    query_block_size=32,
+    tile_size=4096,
+    backend=None,
+    packed=False,
+    exact=False,
 ):
+    """Find the n most identical targets for each query and region.
     
-    seq_identity_matrix = calculate_seq_ids_multiquery(targets, query, region_masks, length_matched, include_ends)
-    seq_identity_matrix[np.isnan(seq_identity_matrix)] = 0
-
-    position_of_n_best = np.argpartition(-seq_identity_matrix, n-1, axis=0)  # partition by seq_id
-
-    n_highest_identities = np.take_along_axis(seq_identity_matrix, position_of_n_best, axis=0)[:n]
-
-    broadcasted_ids = np.broadcast_to(target_ids[:, None, None], (targets.shape[0], query.shape[0], region_masks.shape[0], 2))
-
-    n_highest_ids = np.take_along_axis(broadcasted_ids, position_of_n_best[:, :, :, None], axis=0)[:n]
-
-    return n_highest_identities.transpose((1,0,2)), n_highest_ids.transpose((1,0,2,3))
+    Parameters
+    ----------
+    query : numpy array
+        Canonical alignments of the queries
+    targets : numpy array
+        Canonical alignments of the targets
+    target_ids : numpy array
+        Ids of the targets
+    n : int
+        Number of most identical targets to return
+    backend : str
+        Backend used for the calculations, e.g. 'jax' or 'numpy' (default is None, using default_backend)
+    packed : bool
+        Whether the targets are packed (see packed_encoding). Backends with a get_n_most_identical_packed function 
+        compare them without unpacking, while the targets are unpacked for other backends (default is False)
+    exact : bool
+        Rank targets by their integer identity keys (see identity_keys) instead of float identities, which are 
+        returned instead of the identities. Targets with the same identity are ranked by their ids (file_id and 
+        then line), see id_ranks (default is False)
+
+    Returns
+    -------
+    tuple of numpy arrays
+        Identities (or keys) of shape (queries, n, regions) and ids of shape (queries, n, regions, 2)
+    """
+    
+    search = get_backend(backend)
+    if packed:
+        backend_module = _load_backend(backend)
+        if hasattr(backend_module, 'get_n_most_identical_packed') and packable(query):
+            search = backend_module.get_n_most_identical_packed
+        else:
+            targets = unpack_numberings(targets)
+    
+    options = {'exact': True} if exact else {} # Only passed when used, so backends without exact ranking still work
+    
+    return search(
+        query, targets, target_ids, n=n,
+        region_masks=region_masks, 
+        length_matched=length_matched, 
+        include_ends=include_ends,
+        query_block_size=query_block_size, 
+        tile_size=tile_size,
+        **options,
+    )
 
 
 def slow_calculate_seq_id(ab1, ab2):
@@ -3,6 +3,9 @@ import glob
 import subprocess
 import requests
 
+from kasearch.shard_io import find_shards, read_manifest
+from kasearch.occurrences import read_occurrences
+
 class InitiateDatabase:
     def __init__(self):
         pass
@@ -33,14 +36,18 @@ class InitiateDatabase:
         if allowed_chain == 'Any': allowed_chain = '*'
         
         for species in allowed_species:
-            self.files_to_search_normal += glob.glob(os.path.join(self.database_path, 
-                                                         allowed_chain, 
-                                                         species, 
-                                                         "*data-subset-normal-*.npz"))
-            self.files_to_search_unusual += glob.glob(os.path.join(self.database_path, 
-                                                               allowed_chain, 
-                                                               species, 
-                                                               "*data-subset-unusual-*.npz"))
+            self.files_to_search_normal += find_shards(os.path.join(self.database_path, allowed_chain, species), 'normal')
+            self.files_to_search_unusual += find_shards(os.path.join(self.database_path, allowed_chain, species), 'unusual')
+            
+        self.shard_summaries = {} # Summaries of the files from the manifest of their folder (None for files without one)
+        for folder in set(os.path.dirname(file) for file in self.files_to_search_normal):
+            manifest = read_manifest(folder)
+            self.shard_summaries.update({os.path.join(folder, name): summary for name, summary in manifest.items()})
+        self.shard_summaries = {file: self.shard_summaries.get(file) for file in self.files_to_search_normal}
+        
+        # Occurrence tables of deduplicated folders, mapping the stored sequences to all their occurrences
+        folders = sorted(set(os.path.dirname(file) for file in self.files_to_search_normal))
+        self.occurrence_tables = [table for table in map(read_occurrences, folders) if table is not None]
             
             
 def download_small_oas():
@@ -0,0 +1,315 @@
+import os
+import warnings
+from multiprocessing import cpu_count
+
+import jax
+import jax.numpy as jnp
+
+from functools import partial
+import numpy as np 
+from kasearch.identity_calculations import (
+    default_region_masks, default_length_matched, tile_targets, query_blocks, bucketed_size, identity_key_bits, id_ranks
+)
+
+_configured = False
+
+# Compiled kernels are kept on disk, so new processes load them instead of compiling them again
+default_compilation_cache_dir = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')), 'kasearch', 'jax'
+)
+
+# Compilations in this process, as reported by jax
+_compile_stats = {'compilations': 0, 'compile_time': 0.0, 'persistent_cache_hits': 0, 'persistent_cache_misses': 0}
+
+
+def _record_compile_duration(event, duration, **kwargs):
+    
+    if event.startswith('/jax/core/compile/'):
+        _compile_stats['compile_time'] += duration
+        if event == '/jax/core/compile/backend_compile_duration': _compile_stats['compilations'] += 1
+
+
+def _record_compile_event(event, **kwargs):
+    
+    if event == '/jax/compilation_cache/cache_hits': _compile_stats['persistent_cache_hits'] += 1
+    elif event == '/jax/compilation_cache/cache_misses': _compile_stats['persistent_cache_misses'] += 1
+
+
+jax.monitoring.register_event_duration_secs_listener(_record_compile_duration)
+jax.monitoring.register_event_listener(_record_compile_event)
+
+
+def compile_stats():
+    """
+    Number of kernels compiled (or loaded from the on-disk compilation cache), time spent tracing, lowering and 
+    compiling them in seconds, and number of kernels found (or missing) in the on-disk cache. 
+    This counts all compilations by jax in the process.
+    """
+    
+    return dict(_compile_stats)
+
+
+def _backends_are_initialized():
+    try:
+        from jax._src import xla_bridge
+        return xla_bridge.backends_are_initialized()
+    except (ImportError, AttributeError):
+        return False
+
+
+def configure(n_devices=None, platform='cpu', compilation_cache_dir=None):
+    """Set up jax before its first use. 
+    
+    The targets are split across n_devices (virtual) devices. This only has an effect before jax 
+    has run anything in the process; otherwise the existing devices are used.
+    
+    Parameters
+    ----------
+    n_devices : int
+        Number of devices to split the calculations across (default is None, using the number of CPUs - 2)
+    platform : str
+        Platform jax runs on (default is cpu)
+    compilation_cache_dir : str, bool
+        Folder to keep compiled kernels in between processes (default is None, using default_compilation_cache_dir). 
+        False disables the on-disk cache
+    """
+    
+    global _configured
+    
+    if compilation_cache_dir is not False:
+        jax.config.update('jax_compilation_cache_dir', compilation_cache_dir or default_compilation_cache_dir)
+        jax.config.update('jax_persistent_cache_min_compile_time_secs', 0)
+    
+    if _backends_are_initialized():
+        if n_devices is not None and n_devices != jax.device_count():
+            warnings.warn(f"jax is already initialized with {jax.device_count()} devices, so n_devices={n_devices} is ignored.")
+        _configured = True
+        return
+    
+    n_devices = n_devices if n_devices is not None else max(cpu_count()-2, 1)
+    
+    if platform: 
+        jax.config.update("jax_platforms", platform)
+        
+    if hasattr(jax.config, 'jax_num_cpu_devices'):
+        jax.config.update('jax_num_cpu_devices', n_devices)
+    elif "xla_force_host_platform_device_count" not in os.environ.get("XLA_FLAGS", ""):
+        # Older versions of jax only read the device count from XLA_FLAGS when initializing
+        os.environ["XLA_FLAGS"] = f'{os.environ.get("XLA_FLAGS", "")} --xla_force_host_platform_device_count={n_devices}'.strip()
+        
+    _configured = True
+
+
+@partial(jax.jit, static_argnums=1)
+def chunk(array, chunks):
+    old_size = array.shape[0]
+    if old_size % chunks != 0:
+        chunk_size = old_size//chunks + 1
+        array = jnp.pad(array, ((0,chunks*(chunk_size) - old_size),(0,0)), constant_values=0)
+    else:
+        chunk_size = old_size//chunks
+    return array.reshape(chunks, chunk_size, array.shape[-1])
+
+
+@jax.jit
+def _calculate_single_sequence_identity_average(abs1, abs2, masks, length_matched):
+    comparison = abs1 == abs2
+
+    mask1, mask2 = (abs1 != 0) & (abs1 != 124), (abs2 != 0) & (abs1 != 124)
+    overlapping_residues = comparison * mask1 * mask2
+
+    len1, len2 = mask1 @ masks, mask2 @ masks
+    region_overlap = overlapping_residues @ masks
+    identities = ((region_overlap / len1) + (region_overlap / len2)) * (~length_matched | (len1==len2)) / 2
+    return identities
+
+
+@jax.jit
+def _count_single_sequence_overlap_with_ends(abs1, abs2, masks, length_matched):
+    comparison = abs1 == abs2
+
+    mask1, mask2 = (abs1 != 0) & (abs1 != 124), (abs2 != 0) & (abs2 != 124)    
+    overlapping_residues = comparison * mask1 * mask2
+
+    length = (mask1 | mask2) @ masks
+    region_overlap = overlapping_residues @ masks
+    return region_overlap, length, ~length_matched | ((mask1 @ masks) == (mask2 @ masks))
+
+
+@jax.jit
+def _count_single_sequence_overlap_without_ends(abs1, abs2, masks, length_matched):
+    comparison = abs1 == abs2
+
+    mask1, mask2 = abs1 != 0, abs2 != 0
+    not_missing1, not_missing2 = abs1 != 124, abs2 != 124
+    exists1, exists2 = mask1 * not_missing1, mask2 * not_missing2
+    
+    overlapping_residues = comparison * exists1 * exists2
+
+    length = (mask1 | mask2) * (not_missing1 * not_missing2) @ masks
+    region_overlap = overlapping_residues @ masks
+    return region_overlap, length, ~length_matched | ((exists1 @ masks) == (exists2 @ masks))
+
+
+@jax.jit
+def _calculate_single_sequence_identity_with_ends(abs1, abs2, masks, length_matched):
+    region_overlap, length, matched = _count_single_sequence_overlap_with_ends(abs1, abs2, masks, length_matched)
+    return (region_overlap / length) * matched
+
+
+@jax.jit
+def _calculate_single_sequence_identity_without_ends(abs1, abs2, masks, length_matched):
+    region_overlap, length, matched = _count_single_sequence_overlap_without_ends(abs1, abs2, masks, length_matched)
+    return (region_overlap / length) * matched
+
+
+@jax.jit
+def _calculate_single_sequence_identity(abs1, abs2, masks, length_matched, include_ends):
+    out = jax.lax.cond(
+        include_ends, _calculate_single_sequence_identity_with_ends,
+        _calculate_single_sequence_identity_without_ends, abs1, abs2,
+        masks, length_matched)
+    return out
+
+
+@jax.jit
+def _calculate_chunked_sequence_identity(abs1, abs2, masks, length_matched, include_ends):
+    # Vectorized over the queries (abs2), so the traced program does not grow with the number of queries
+    return jax.vmap(
+        _calculate_single_sequence_identity, in_axes=(None, 0, None, None, None), out_axes=1
+    )(abs1, abs2, masks, length_matched, include_ends)
+
+
+@jax.jit
+def _calculate_single_sequence_key(abs1, abs2, masks, length_matched, include_ends):
+    # Integer key of the identity (see identity_calculations.identity_keys), held as float32 as top_k is far faster for floats on cpu
+    region_overlap, length, matched = jax.lax.cond(
+        include_ends, _count_single_sequence_overlap_with_ends,
+        _count_single_sequence_overlap_without_ends, abs1, abs2,
+        masks, length_matched)
+    
+    identities = region_overlap.astype(jnp.float32) / jnp.maximum(length, 1).astype(jnp.float32)
+    keys = jnp.rint(identities * (1 << identity_key_bits))
+    return jnp.where(matched & (length > 0), keys, 0)
+
+
+@jax.jit
+def _calculate_chunked_sequence_key(abs1, abs2, masks, length_matched, include_ends):
+    return jax.vmap(
+        _calculate_single_sequence_key, in_axes=(None, 0, None, None, None), out_axes=1
+    )(abs1, abs2, masks, length_matched, include_ends)
+
+
+calculate_many_sequence_identities = jax.pmap(_calculate_chunked_sequence_identity, in_axes=(0,None,None,None,None))
+
+
+def _n_most_identical_in_tiles(tiles, first_row, n_valid, abs2, masks, length_matched, include_ends, n, exact=False):
+    """
+    Scans tiles of targets while only keeping the n most identical targets for each query and region. 
+    
+    Memory therefore scales with the tile size and n, instead of the number of targets. With exact, the integer 
+    keys of the identities are kept instead, and targets with the same key are ranked by row (top_k keeps the first), 
+    which get_n_most_identical_multiquery orders by id.
+    """
+    
+    n_queries, n_regions, tile_size = abs2.shape[0], masks.shape[1], tiles.shape[1]
+    
+    def update(best, tile_and_rows):
+        tile, rows = tile_and_rows
+        
+        if exact:
+            identities = _calculate_chunked_sequence_key(tile, abs2, masks, length_matched, include_ends)
+        else:
+            identities = _calculate_chunked_sequence_identity(tile, abs2, masks, length_matched, include_ends)
+            identities = jnp.where(jnp.isnan(identities), 0, identities)
+        identities = jnp.where((rows < n_valid)[:, None, None], identities, -1)  # Padding is never selected
+        identities = jnp.transpose(identities, (1, 2, 0))
+        
+        all_identities = jnp.concatenate([best[0], identities], axis=-1)
+        all_rows = jnp.concatenate([best[1], jnp.broadcast_to(rows, identities.shape)], axis=-1)
+        
+        best_identities, position_of_n_best = jax.lax.top_k(all_identities, n)
+        return (best_identities, jnp.take_along_axis(all_rows, position_of_n_best, axis=-1)), None
+    
+    init = (jnp.full((n_queries, n_regions, n), -1, jnp.float32), jnp.zeros((n_queries, n_regions, n), jnp.int32))
+    rows = first_row + jnp.arange(tiles.shape[0] * tile_size, dtype=jnp.int32).reshape(-1, tile_size)
+    
+    best, _ = jax.lax.scan(update, init, (tiles, rows))
+    return best
+
+
+calculate_n_most_identical = jax.pmap(
+    _n_most_identical_in_tiles, in_axes=(0,0,None,None,None,None,None,None,None), static_broadcasted_argnums=(7,8)
+)
+
+
+def calculate_seq_ids_multiquery(array_of_abs1, array_of_abs2, region_masks, length_matched, include_ends, query_block_size=32):
+    if not _configured: configure()
+    
+    masks, length_matched, include_ends = jnp.array(region_masks.T), jnp.array(length_matched), jnp.array(include_ends)
+    
+    # Targets are padded to a bucketed number of rows, so targets of similar sizes use the same compiled kernels
+    padded_abs1 = np.zeros((bucketed_size(array_of_abs1.shape[0]), array_of_abs1.shape[1]), array_of_abs1.dtype)
+    padded_abs1[:array_of_abs1.shape[0]] = array_of_abs1
+    
+    abs1, = _on_devices(chunk(jax.lax.stop_gradient(padded_abs1), jax.device_count())) # Transferred once for all query blocks
+
+    identities = np.concatenate([
+        np.array(calculate_many_sequence_identities(abs1, jnp.array(abs2), masks, length_matched, include_ends))
+        for abs2 in query_blocks(array_of_abs2, query_block_size)
+    ], axis=2)[:, :, :array_of_abs2.shape[0]]
+    
+    return identities.reshape(-1, array_of_abs2.shape[0], len(region_masks))[:array_of_abs1.shape[0]]   
+
+
+def _on_devices(*arrays):
+    """
+    Put arrays on the devices, split along their first axis as pmap splits its inputs, so they are only transferred once.
+    """
+    
+    sharding = jax.sharding.NamedSharding(jax.sharding.Mesh(np.array(jax.devices()), ('devices',)), jax.sharding.PartitionSpec('devices'))
+    return tuple(jax.device_put(array, sharding) for array in arrays)
+
+
+def get_n_most_identical_multiquery(
+    query, targets, target_ids, n=10,
+    region_masks=default_region_masks,
+    length_matched=default_length_matched,
+    include_ends=True,
+    query_block_size=32,
+    tile_size=4096,
+    exact=False,
+):
+    if not _configured: configure()
+    
+    masks, length_matched, include_ends = jnp.array(region_masks.T), jnp.array(length_matched), jnp.array(include_ends)
+    
+    if exact: # Targets with the same key are ranked by row, so the rows are put in the order of their ids
+        order = np.argsort(id_ranks(target_ids))
+        if np.any(np.diff(order) < 0): 
+            targets, target_ids = np.asarray(targets)[order], np.asarray(target_ids)[order]
+    
+    tiles, first_rows = _on_devices(*tile_targets(np.asarray(targets), jax.device_count(), tile_size)) # Transferred once for all query blocks
+    n_kept = bucketed_size(n) # Only the n most identical are returned, but few values of n are compiled
+    
+    identities, rows = [], []
+    for abs2 in query_blocks(query, query_block_size):
+        # Each device returns its n most identical targets, which are merged below
+        block_identities, block_rows = calculate_n_most_identical(
+            tiles, first_rows, targets.shape[0], jnp.array(abs2), masks, length_matched, include_ends, n_kept, exact
+        )
+        identities.append(np.moveaxis(np.array(block_identities), 0, -2).reshape(abs2.shape[0], region_masks.shape[0], -1))
+        rows.append(np.moveaxis(np.array(block_rows), 0, -2).reshape(abs2.shape[0], region_masks.shape[0], -1))
+    
+    identities, rows = np.concatenate(identities)[:query.shape[0]], np.concatenate(rows)[:query.shape[0]]
+    if exact: identities = identities.astype(np.int32) # Keys are exact integers up to 2**24 in float32
+    
+    if exact: # Rows (and so ids) increase across devices, so a stable sort keeps ranking equal keys by id
+        position_of_n_best = np.argsort(-identities, axis=-1, kind='stable')[..., :n]
+    else:
+        position_of_n_best = np.argsort(-identities, axis=-1)[..., :n]
+    
+    n_highest_identities = np.take_along_axis(identities, position_of_n_best, axis=-1)
+    n_highest_ids = target_ids[np.minimum(np.take_along_axis(rows, position_of_n_best, axis=-1), targets.shape[0] - 1)]
+
+    return n_highest_identities.transpose((0,2,1)), n_highest_ids.transpose((0,2,1,3))
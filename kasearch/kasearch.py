@@ -1,13 +1,30 @@
 import os
-import time
+import uuid
+import multiprocessing
+from collections import deque
 
 import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from concurrent.futures.thread import ThreadPoolExecutor
 
-from kasearch.identity_calculations import get_n_most_identical_multiquery, slow_get_n_most_identical
+from kasearch.identity_calculations import (
+    get_n_most_identical_multiquery, configure_backend, compile_stats, identities_from_keys, keys_from_identities
+)
 from kasearch.meta_extract import ExtractMetadata
 from kasearch.initiate_db import InitiateDatabase
-from kasearch.canonical_alignment import get_region_mask
+from kasearch.canonical_alignment import get_region_mask, canonical_numbering_len
+from kasearch.shard_io import load_shard
+from kasearch.lru_cache import LRUCache
+from kasearch.unusual_identity import get_n_most_identical_unusual, sequence_keys, concatenate_keys
+from kasearch.region_index import length_filter, summary_filter, identity_bound, summary_block_size
+from kasearch.occurrences import expand_occurrences
+
+_shard_keys = ['numberings', 'idxs', 'region_lengths', 'block_residues']
+
+# Raw (memory-mapped) shards are scanned in parallel as ranges of this many rows, a multiple of summary_block_size
+scan_unit_rows = 64 * summary_block_size
 
 
 class SearchDB(InitiateDatabase, ExtractMetadata):
@@ -20,15 +37,31 @@ class SearchDB(InitiateDatabase, ExtractMetadata):
     ----------
     current_best_identities : array_like
         Array of the ordered closest identities
+    current_best_keys : array_like
+        With exact_ranking, the integer keys the closest sequences are ranked by (see identity_calculations.identity_keys)
     files_to_search_normal : list of str
         List of files that will be searched
+    cache_stats : dict, None
+        Hits, misses and evictions of the in-memory cache of files (None if not preloaded)
+    meta_cache_stats : dict
+        Hits, misses and evictions of the caches of fetched meta data
+    compile_stats : dict, None
+        Number and duration of the compilations of the backend's kernels (None for backends which are not compiled)
 
     Methods
     -------
-    search(query, keep_best_n=10)
-        Search files in files_to_search_normal with query
-    get_meta(n_query = 0, n_region = 0, n_sequences = 'all', n_jobs = 1)
+    search(query, keep_best_n=10, search_unusual=False, n_workers=None)
+        Search files in files_to_search_normal (and files_to_search_unusual) with query
+    warm(memory_budget=None)
+        Load files in files_to_search_normal into memory for repeated searches
+    close()
+        Shut down the threads used for loading files and the processes used for parallel searches
+    get_meta(n_query = 0, n_region = 0, n_sequences = 'all', n_jobs = 1, all_occurrences = False)
         Retrieve meta data for n_query spanning n_region and returning n_sequences
+    get_meta_all(n_sequences = 'all', n_jobs = 1, all_occurrences = False)
+        Retrieve meta data for all queries and regions, returning n_sequences for each
+    get_meta_table(n_sequences = 'all', n_jobs = 1, all_occurrences = False)
+        Retrieve meta data for all queries and regions as a single long-format table
     """
     
     def __init__(
@@ -40,12 +73,29 @@ class SearchDB(InitiateDatabase, ExtractMetadata):
         length_matched=[False,True,True],
         include_ends=True,
         local_oas_path = None,
+        preload = False,
+        memory_budget = None,
+        prefetch = 2,
+        query_batch_size = 32,
+        backend = None,
+        n_devices = None,
+        meta_cache_size = 100_000,
+        study_cache_folder = None,
+        study_cache_size = 5_000_000_000,
+        transport = None,
+        compilation_cache_dir = None,
+        exact_ranking = False,
+        n_workers = 1,
     ):
         super().__init__()
         
         self.region_masks = np.stack([get_region_mask(region) for region in regions])
         self.length_matched = np.array(length_matched, dtype = bool)
         self.include_ends = include_ends
+        
+        # Positions outside all regions do not change the identities, so only the positions within a region are loaded
+        needed_columns = self.region_masks.any(0)
+        self._columns = None if needed_columns.all() else np.flatnonzero(needed_columns)
         assert self.region_masks.shape[0] == self.length_matched.shape[0], "List of user-defined regions ({}) and 'if length match' ({})\
  are of different lengths. Please define a 'if length match' for each defined region.".format(self.region_masks.shape[0], self.length_matched.shape[0])
         
@@ -53,8 +103,96 @@ class SearchDB(InitiateDatabase, ExtractMetadata):
         self._set_files_to_search(allowed_chain, allowed_species)
         
         self._set_id_to_study(self.database_path, local_oas_path)
+        self._set_meta_cache(meta_cache_size)
+        self._set_study_fetcher(study_cache_folder, max_size=study_cache_size, transport=transport)
         
         assert len(self.files_to_search_normal) != 0, "DB does not contain data of {} chains from the {} species.".format(allowed_chain, allowed_species)
+        
+        self.prefetch = prefetch
+        self.query_batch_size = query_batch_size
+        self.backend = backend
+        self.n_devices = n_devices
+        self.compilation_cache_dir = compilation_cache_dir
+        self.exact_ranking = exact_ranking
+        self.n_workers = n_workers
+        self._backend_configured = False
+        self._loader_pool = ThreadPoolExecutor(max_workers=max(prefetch, 1))
+        self._scan_pool, self._scan_pool_size = None, 0
+        
+        self._shard_cache = None
+        self._unusual_keys = {}
+        if preload: self.warm(memory_budget)
+        
+    def close(self):
+        """
+        Shut down the threads used for loading files and meta data, and the processes used for parallel searches.
+        """
+        
+        self._loader_pool.shutdown(wait=False, cancel_futures=True)
+        self._close_meta_pool()
+        self._close_scan_pool()
+    
+    def _close_scan_pool(self):
+        
+        if self._scan_pool is not None:
+            self._scan_pool.shutdown(wait=False, cancel_futures=True)
+            self._scan_pool = None
+        
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+    
+    def warm(self, memory_budget=None):
+        """Load the files to search into memory, so later searches skip reading them from disk.
+        
+        Parameters
+        ----------
+        memory_budget : int
+            Maximum number of bytes to keep in memory. Least recently used files are evicted 
+            when the budget is exceeded (default is None, keeping all files)
+        """
+        
+        if self._shard_cache is None or self._shard_cache.max_size != memory_budget:
+            self._shard_cache = LRUCache(max_size=memory_budget, sizeof=_shard_nbytes)
+        
+        for file in self.files_to_search_normal:
+            if file not in self._shard_cache: self._load_shard(file)
+                
+    @property
+    def compile_stats(self):
+        return compile_stats(self.backend) if self._backend_configured else None
+    
+    @property
+    def cache_stats(self):
+        return self._shard_cache.stats if self._shard_cache is not None else None
+    
+    def _load_shard(self, file):
+        """
+        Load a file, using the in-memory cache if the database has been warmed.
+        """
+        
+        if self._shard_cache is None:
+            return self._load_columns(file)
+        
+        data = self._shard_cache.get(file)
+        if data is None:
+            data = {key: np.array(array) for key, array in self._load_columns(file).items()}
+            self._shard_cache.put(file, data)
+        
+        return data
+    
+    def _load_columns(self, file):
+        """
+        Load a file, with only the positions within the searched regions for files with the column layout. 
+        The loaded positions are then kept in data['columns']. Files with the packed layout are kept packed.
+        """
+        
+        data = load_shard(file, keys=_shard_keys, columns=self._columns, packed=True)
+        if 'numberings' in data and data['numberings'].shape[1] < canonical_numbering_len: data['columns'] = self._columns
+        
+        return data
     
     def _reset_current_best(self, qsize=1):
         """
@@ -63,24 +201,73 @@ class SearchDB(InitiateDatabase, ExtractMetadata):
         
         self.current_best_identities = np.zeros((qsize, 1, self.region_masks.shape[0]), np.float16) - 1
         self.current_best_ids = np.zeros((qsize, 1, self.region_masks.shape[0], 2), np.int32) - 1
+        
+        if self.exact_ranking: # Sequences are ranked by integer keys, only converted to identities for the closest sequences
+            self.current_best_keys = np.zeros((qsize, 1, self.region_masks.shape[0]), np.int32) - 1
+            self.current_best_identities = identities_from_keys(self.current_best_keys)
 
-    def _update_best(self, query, _current_target_numbering, _current_target_ids, keep_best_n):
+    def _update_best(self, query, data, keep_best_n):
         """
         Update the current most similar sequences.
         """
-
-        keep_best_n = min(keep_best_n, _current_target_numbering.shape[0])
+        
+        packed = 'packed_numberings' in data
+        _current_target_numbering, _current_target_ids = data['packed_numberings' if packed else 'numberings'], data['idxs']
+        
+        # Skip sequences which cannot match any query, as they differ in length in all length matched regions
+        keep = length_filter(query, data, self.region_masks, self.length_matched)
+        
+        # Skip blocks of sequences which cannot be more identical than the current n'th most identical sequence
+        if self.current_best_identities.shape[1] >= keep_best_n:
+            bound = identity_bound(query, data, self.region_masks, self.length_matched, self.include_ends, self.query_batch_size)
+            if bound is not None:
+                threshold = self.current_best_identities[:, keep_best_n - 1][None]
+                if self.exact_ranking: threshold = threshold - 1e-6 # Ties with the n'th most identical can still rank higher by id
+                can_improve = (bound >= threshold).any(axis=(1, 2))
+                can_improve = np.repeat(can_improve, summary_block_size)[:_current_target_numbering.shape[0]]
+                keep = can_improve if keep is None else keep & can_improve
+        
+        if keep is not None:
+            if not keep.any(): return
+            _current_target_numbering, _current_target_ids = _current_target_numbering[keep], _current_target_ids[keep]
+        
+        region_masks = self.region_masks
+        if 'columns' in data: # Queries and regions are compared at the loaded positions only
+            query, region_masks = query[:, data['columns']], region_masks[:, data['columns']]
                 
         chunk_best_identities, chunk_best_ids = get_n_most_identical_multiquery(
             query,
             _current_target_numbering,
             _current_target_ids, 
-            n=keep_best_n,
-            region_masks=self.region_masks, 
+            n=min(keep_best_n, _current_target_numbering.shape[0]),
+            region_masks=region_masks, 
             length_matched=self.length_matched,
             include_ends=self.include_ends,
+            query_block_size=self.query_batch_size,
+            backend=self.backend,
+            packed=packed,
+            exact=self.exact_ranking,
         )
         
+        self._merge_best(chunk_best_identities, chunk_best_ids, keep_best_n)
+        
+    def _merge_best(self, chunk_best_identities, chunk_best_ids, keep_best_n):
+        """
+        Merge the most similar sequences of a file into the current most similar sequences. With exact_ranking, 
+        the identities of the file are keys, and sequences with the same key are ranked by their ids.
+        """
+        
+        if self.exact_ranking:
+            all_keys = np.concatenate([chunk_best_identities, self.current_best_keys], axis=1)
+            all_ids = np.concatenate([chunk_best_ids, self.current_best_ids], axis=1)
+            
+            order = np.lexsort((all_ids[..., 1], all_ids[..., 0], -all_keys.astype(np.int64)), axis=1)
+            
+            self.current_best_keys = np.take_along_axis(all_keys, order, axis=1)[:, :keep_best_n]
+            self.current_best_ids = np.take_along_axis(all_ids, order[:, :, :, None], axis=1)[:, :keep_best_n]
+            self.current_best_identities = identities_from_keys(self.current_best_keys)
+            return
+        
         all_identities = np.concatenate([chunk_best_identities, self.current_best_identities], axis=1)
         all_ids = np.concatenate([chunk_best_ids, self.current_best_ids], axis=1)
 
@@ -89,9 +276,43 @@ class SearchDB(InitiateDatabase, ExtractMetadata):
         self.current_best_identities = np.take_along_axis(all_identities, order, axis=1)[:, :keep_best_n]
         self.current_best_ids = np.take_along_axis(all_ids, order[:, :, :, None], axis=1)[:, :keep_best_n]        
         
+    def _load_unusual_keys(self, file):
+        """
+        Load the keys of the sequences in a file of unusual sequences, which are kept for later searches.
+        """
+        
+        if file not in self._unusual_keys:
+            data = load_shard(file, keys=['numberings', 'idxs'], mmap=False)
+            self._unusual_keys[file] = (*concatenate_keys(sequence_keys(data['numberings'])), data['idxs'])
+        
+        return self._unusual_keys[file]
+    
+    def _update_best_unusual(self, query, file, keep_best_n):
+        """
+        Update the current most similar sequences with the sequences in a file of unusual sequences.
+        """
+        
+        target_keys, target_sequence, target_ids = self._load_unusual_keys(file)
+        if target_ids.shape[0] == 0: return
+        
+        chunk_best_identities, chunk_best_ids = get_n_most_identical_unusual(
+            query,
+            target_keys,
+            target_sequence,
+            target_ids,
+            n=min(keep_best_n, target_ids.shape[0]),
+            region_masks=self.region_masks, 
+            length_matched=self.length_matched,
+        )
+        if self.exact_ranking: chunk_best_identities = keys_from_identities(chunk_best_identities)
+        
+        self._merge_best(chunk_best_identities, chunk_best_ids, keep_best_n)
+        
     def search(self, 
                query, 
                keep_best_n: int = 10,
+               search_unusual: bool = False,
+               n_workers: int = None,
               ):
         """Search database for sequences most similar to the queries.
         
@@ -101,25 +322,130 @@ class SearchDB(InitiateDatabase, ExtractMetadata):
             Antibody sequence to search with
         keep_best_n : int
             Number of closest matches to return (default is 10)
+        search_unusual : bool
+            Also search unusual sequences, i.e. sequences with positions outside the canonical alignment (default is False). 
+            These are compared by their ANARCI numbering, with identities averaged over the length of both sequences 
+            as in slow_calculate_seq_id, and are numbered with ANARCI when first searched if not from OAS
+        n_workers : int
+            Number of processes scanning the files in parallel (default is None, using the n_workers of the database). 
+            With more than one, the files are split into units (see _scan_units), which idle processes take from a 
+            shared queue and search with the numpy backend. The processes are spawned and import the calling script, 
+            which must therefore only search under an `if __name__ == '__main__':` guard (see _parallel_search)
         """
         
+        n_workers = n_workers if n_workers is not None else self.n_workers
+        
+        if n_workers == 1 and not self._backend_configured: # Backends are only imported and set up when first needed
+            configure_backend(self.backend, n_devices=self.n_devices, compilation_cache_dir=self.compilation_cache_dir)
+            self._backend_configured = True
+        
         self._reset_current_best(query.shape[0])
         
-        data_loader = DataLoader(self.files_to_search_normal[0])
-        _current_target_numbering, _current_target_ids = data_loader.data['numberings'], data_loader.data['idxs']
+        files_to_search = self.files_to_search_normal
+        if self.length_matched.all(): # Skip files without sequences of the same region lengths as any of the queries
+            keep = summary_filter(query, [self.shard_summaries[file] for file in files_to_search], self.region_masks, self.length_matched)
+            files_to_search = [file for file, keep_file in zip(files_to_search, keep) if keep_file]
         
-        for file in self.files_to_search_normal[1:]:
-            data_loader = DataLoader(file)
-            self._update_best(query, _current_target_numbering, _current_target_ids, keep_best_n)
-            _current_target_numbering, _current_target_ids = data_loader.data['numberings'], data_loader.data['idxs']
-                
-        self._update_best(query, _current_target_numbering, _current_target_ids, keep_best_n)
+        if self._shard_cache is not None: # Search cached files first, so they are not evicted before being used
+            files_to_search = sorted(files_to_search, key=lambda file: file not in self._shard_cache)
+        
+        if n_workers > 1:
+            self._parallel_search(query, files_to_search, keep_best_n, n_workers)
+        else:
+            for data in DataLoader(files_to_search, self._load_shard, prefetch=self.prefetch, pool=self._loader_pool):
+                self._update_best(query, data, keep_best_n)
+            
+        if search_unusual:
+            for file in self.files_to_search_unusual:
+                self._update_best_unusual(query, file, keep_best_n)
+        
+    def _scan_units(self, files):
+        """
+        Units of work of a parallel search, as (file, first row, last row). Raw shards are split into ranges of 
+        scan_unit_rows rows, which are read from their memory-map, while compressed shards are searched whole (None).
+        """
+        
+        for file in files:
+            if not os.path.isdir(file): 
+                yield file, None, None
+                continue
+            
+            n_sequences = load_shard(file, keys=['idxs'])['idxs'].shape[0]
+            for start in range(0, n_sequences, scan_unit_rows):
+                yield file, start, min(start + scan_unit_rows, n_sequences)
+    
+    def _scan_settings(self):
+        """
+        Attributes needed to search files in worker processes (see _scan_unit), which use the numpy backend.
+        """
+        
+        return {
+            'region_masks': self.region_masks, 'length_matched': self.length_matched, 'include_ends': self.include_ends, 
+            'exact_ranking': self.exact_ranking, 'query_batch_size': self.query_batch_size, '_columns': self._columns,
+            'backend': 'numpy', '_shard_cache': None,
+        }
+    
+    def _parallel_search(self, query, files, keep_best_n, n_workers):
+        """Search files with a pool of processes, which is started on the first parallel search and reused.
+        
+        Each process keeps its own most similar sequences across the units it searches, and skips blocks which cannot 
+        beat them. After each unit it returns them, replacing those it returned before, and the most similar sequences 
+        of all processes are merged once all units are searched. With exact_ranking, sequences with the same identity 
+        are ranked by id everywhere, so the result is the same as searching in one process, however the files are split.
+        
+        The processes are spawned, so they import the __main__ module of the calling script, which must therefore only 
+        search under an `if __name__ == '__main__':` guard. Otherwise the processes fail to start, which raises a RuntimeError.
+        """
+        
+        if self._scan_pool is None or self._scan_pool_size != n_workers:
+            self._close_scan_pool()
+            # Spawned, as forking a process using jax (with its threads) is unsafe
+            self._scan_pool = ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn'))
+            self._scan_pool_size = n_workers
+        
+        search_id, settings = uuid.uuid4().hex, self._scan_settings()
+        futures = [self._scan_pool.submit(_scan_unit, (search_id, settings, query, keep_best_n, *unit)) for unit in self._scan_units(files)]
+        
+        worker_best = {}
+        try:
+            for future in as_completed(futures):
+                worker, n_units, best_identities, best_ids = future.result()
+                # Units finishing together can be returned in any order, so only the result of the most units is kept
+                if worker not in worker_best or worker_best[worker][0] < n_units: 
+                    worker_best[worker] = (n_units, best_identities, best_ids)
+        except BrokenProcessPool as error:
+            self._close_scan_pool()
+            raise RuntimeError(
+                "The processes searching in parallel exited unexpectedly. They are spawned and import the script searching, "
+                "so scripts searching with n_workers > 1 must only search under an `if __name__ == '__main__':` guard."
+            ) from error
+        
+        for _, best_identities, best_ids in worker_best.values():
+            self._merge_best(best_identities, best_ids, keep_best_n)
+    
+    def _occurrences_of(self, ids, all_occurrences=False):
+        """
+        Ids of the closest sequences, or of all their occurrences with all_occurrences, with the index of the sequence 
+        each id belongs to and the number of occurrences of the sequence (None if the database is not deduplicated).
+        """
+        
+        if not self.occurrence_tables: 
+            return ids, np.arange(ids.shape[0]), None
+        
+        occurrence_ids, owners = expand_occurrences(self.occurrence_tables, ids)
+        n_occurrences = np.bincount(owners, minlength=ids.shape[0])
+        
+        if all_occurrences: 
+            return occurrence_ids, owners, n_occurrences[owners]
+        
+        return ids, np.arange(ids.shape[0]), n_occurrences
         
     def get_meta(self, 
                  n_query: int = 0, 
                  n_region: int = 0, 
                  n_sequences = 'all', 
-                 n_jobs: int =1
+                 n_jobs: int =1,
+                 all_occurrences = False,
                 ):
         """Retrieve meta data for the current closest sequences for a specific query and region.
         
@@ -133,11 +459,15 @@ class SearchDB(InitiateDatabase, ExtractMetadata):
             The number of sequences to return, or 'all' for all
         n_jobs : int
             The number of threads to use
+        all_occurrences : bool
+            For deduplicated databases, whether to return a row for every occurrence of the closest sequences 
+            instead of one for each unique sequence (default is False)
 
         Returns
         -------
         pandas dataframe
-            A pandas dataframe with the keep_best_n closest sequences, and their meta data, to the specified query and region
+            A pandas dataframe with the keep_best_n closest sequences, and their meta data, to the specified query and region.
+            For deduplicated databases, the column Occurrences holds the number of occurrences of each sequence.
         """
         
         if n_sequences == 'all':
@@ -147,27 +477,202 @@ class SearchDB(InitiateDatabase, ExtractMetadata):
         assert n_region >= 0
         assert n_sequences > 0        
         
-        metadf = self._extract_meta(self.current_best_ids[n_query, :n_sequences, n_region], n_jobs=n_jobs)
-        metadf['Identity'] = self.current_best_identities[n_query, :n_sequences, n_region]
+        ids = self.current_best_ids[n_query, :n_sequences, n_region]
+        found = ids[:, 0] >= 0 # Fewer sequences than requested are found if too few match in length
+        
+        ids, owners, n_occurrences = self._occurrences_of(ids[found], all_occurrences)
+        
+        metadf = self._extract_meta(ids, n_jobs=n_jobs)
+        metadf['Identity'] = self.current_best_identities[n_query, :n_sequences, n_region][found][owners]
+        if n_occurrences is not None: metadf['Occurrences'] = n_occurrences
         return metadf
+    
+    def get_meta_all(self, n_sequences = 'all', n_jobs: int = 1, all_occurrences = False):
+        """Retrieve meta data for the current closest sequences for all queries and regions.
+        
+        The meta data of all closest sequences is fetched together, so each study is read at most once.
+        
+        Parameters
+        ----------
+        n_sequences : int, str
+            The number of sequences to return for each query and region, or 'all' for all
+        n_jobs : int
+            The number of threads to use
+        all_occurrences : bool
+            For deduplicated databases, whether to return a row for every occurrence of the closest sequences (default is False)
+
+        Returns
+        -------
+        list of lists of pandas dataframes
+            A dataframe, as returned by get_meta, for each query (outer list) and region (inner list)
+        """
+        
+        if n_sequences == 'all':
+            n_sequences = self.current_best_identities.shape[1]
+            
+        assert n_sequences > 0
+        
+        ids = self.current_best_ids[:, :n_sequences]
+        found = ids[..., 0] >= 0
+        
+        fetched = self._fetch_meta(self._occurrences_of(ids[found], all_occurrences)[0], n_jobs=n_jobs) if found.any() else ({}, {})
+        
+        all_meta = []
+        for n_query in range(ids.shape[0]):
+            all_meta.append([])
+            for n_region in range(ids.shape[2]):
+                region_found = found[n_query, :, n_region]
+                region_ids, owners, n_occurrences = self._occurrences_of(ids[n_query, region_found, n_region], all_occurrences)
+                
+                metadf = self._extract_meta(region_ids, fetched=fetched)
+                metadf['Identity'] = self.current_best_identities[n_query, :n_sequences, n_region][region_found][owners]
+                if n_occurrences is not None: metadf['Occurrences'] = n_occurrences
+                all_meta[-1].append(metadf)
+        
+        return all_meta
+    
+    def get_meta_table(self, n_sequences = 'all', n_jobs: int = 1, all_occurrences = False):
+        """Retrieve meta data for the current closest sequences for all queries and regions as a single table.
+        
+        Parameters
+        ----------
+        n_sequences : int, str
+            The number of sequences to return for each query and region, or 'all' for all
+        n_jobs : int
+            The number of threads to use
+        all_occurrences : bool
+            For deduplicated databases, whether to return a row for every occurrence of the closest sequences (default is False)
+
+        Returns
+        -------
+        pandas dataframe
+            A dataframe with a row for each closest sequence of each query and region, with the columns query, 
+            region and rank (the indexes of the query, region and position among the closest sequences), 
+            Identity and the meta data of the sequence (and Occurrences for deduplicated databases)
+        """
+        
+        if n_sequences == 'all':
+            n_sequences = self.current_best_identities.shape[1]
+            
+        assert n_sequences > 0
+        
+        ids = self.current_best_ids[:, :n_sequences]
+        found = ids[..., 0] >= 0
+        
+        # Index of the query, rank and region of each found sequence
+        n_query, rank, n_region = np.nonzero(found)
+        found_ids, owners, n_occurrences = self._occurrences_of(ids[n_query, rank, n_region], all_occurrences)
+        n_query, rank, n_region = n_query[owners], rank[owners], n_region[owners]
+        
+        if found_ids.shape[0] == 0: 
+            return pd.DataFrame(columns=['query', 'region', 'rank', 'Identity'])
+        
+        unique_ids, inverse = np.unique(found_ids, axis=0, return_inverse=True)
+        
+        metadf = self._extract_meta(unique_ids, n_jobs=n_jobs)
+        metadf = metadf.iloc[inverse.reshape(-1)].reset_index(drop=True)
+        
+        metadf.insert(0, 'query', n_query)
+        metadf.insert(1, 'region', n_region)
+        metadf.insert(2, 'rank', rank)
+        metadf.insert(3, 'Identity', self.current_best_identities[:, :n_sequences][n_query, rank, n_region])
+        if n_occurrences is not None: metadf['Occurrences'] = n_occurrences
+        
+        return metadf.sort_values(['query', 'region', 'rank']).reset_index(drop=True)
   
         
+def _shard_nbytes(data):
+    return sum(array.nbytes for array in data.values())
+
+        
+# Search of the current worker process (see SearchDB._parallel_search), i.e. its id and the SearchDB keeping the most similar sequences
+_worker_search = {'search_id': None, 'searcher': None, 'units': 0}
+
+
+def _scan_unit(task):
+    """
+    Search a unit (file and range of rows) in a worker process, returning the process id, the number of units it has searched 
+    and the most similar sequences found by the process in all units of the search so far.
+    """
+    
+    search_id, settings, query, keep_best_n, file, start, stop = task
+    
+    if _worker_search['search_id'] != search_id:
+        searcher = SearchDB.__new__(SearchDB)
+        searcher.__dict__.update(settings)
+        searcher._reset_current_best(query.shape[0])
+        _worker_search.update(search_id=search_id, searcher=searcher, units=0)
+    
+    searcher = _worker_search['searcher']
+    
+    data = searcher._load_shard(file)
+    if start is not None: data = _row_range(data, start, stop)
+    searcher._update_best(query, data, keep_best_n)
+    _worker_search['units'] += 1
+    
+    best_identities = searcher.current_best_keys if searcher.exact_ranking else searcher.current_best_identities
+    return os.getpid(), _worker_search['units'], best_identities, searcher.current_best_ids
+
+
+def _row_range(data, start, stop):
+    """
+    Rows start to stop of the data of a shard, with the block summaries of these rows (start is a multiple of summary_block_size).
+    """
+    
+    rows = {key: array for key, array in data.items() if key not in ['block_residues', 'columns']}
+    rows = {key: array[start:stop] for key, array in rows.items()}
+    
+    if 'columns' in data: rows['columns'] = data['columns']
+    if 'block_residues' in data: rows['block_residues'] = data['block_residues'][start // summary_block_size:-(-stop // summary_block_size)]
+    
+    return rows
+
+
 class DataLoader():
-    def __init__(self, file):
-        _pool = ThreadPoolExecutor()
-        self.__data = _pool.submit(self.__load_data, file)
+    """
+    Streams the data of a list of files, loading up to prefetch files ahead of the one currently used. 
+    
+    At most prefetch + 1 files are held in memory at a time. Memory-mapped arrays are read into 
+    the page cache in the background, so loading overlaps with searching the previous file.
+    """
+    
+    def __init__(self, files, load_data=None, prefetch=2, pool=None):
+        self.files = files
+        self.prefetch = max(prefetch, 1)
+        self._load_data = load_data if load_data is not None else self.__load_data
+        self._pool = pool if pool is not None else ThreadPoolExecutor(max_workers=self.prefetch)
         
     def __load_data(self, file):
-        data = np.load(file, allow_pickle=True)
-        output = {}
-        output['numberings'] = data['numberings']
-        output['idxs'] = data['idxs']
+        # Raw (npy) shards are memory-mapped, so repeated searches are served from the page cache
+        return load_shard(file, keys=['numberings', 'idxs'])
+    
+    def __load_and_read(self, file):
+        data = self._load_data(file)
+        for array in data.values():
+            if isinstance(array, np.memmap): _read_pages(array)
+        return data
         
-        return output
+    def __iter__(self):
+        files = iter(self.files)
+        pending = deque(self._pool.submit(self.__load_and_read, file) for _, file in zip(range(self.prefetch), files))
         
-    @property
-    def data(self):
-        while self.__data.running():  # Want to acess only if it has finished
-            time.sleep(1)
-        return self.__data.result()
+        try:
+            while pending:
+                data = pending.popleft().result()  # Blocks until the next file is loaded
+                
+                for file in files: 
+                    pending.append(self._pool.submit(self.__load_and_read, file))
+                    break
+                    
+                yield data
+        finally:
+            for future in pending: future.cancel()
+            
+
+def _read_pages(array, page_size=4096):
+    """
+    Touch one element per page of a memory-mapped array, so the file is read into the page cache.
+    """
     
+    flat = array.reshape(-1)
+    if flat.size: flat[::max(page_size // flat.itemsize, 1)].sum()
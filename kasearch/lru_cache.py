@@ -0,0 +1,89 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    A size bounded least-recently-used cache, keeping track of hits, misses and evictions.
+
+    ...
+
+    Attributes
+    ----------
+    max_size : int, None
+        Maximum total size of the cached values, or None for no limit
+    size : int
+        Current total size of the cached values
+    stats : dict
+        Number of hits, misses and evictions, together with the current and maximum size
+
+    Methods
+    -------
+    get(key, default=None)
+        Return the value for key and mark it as recently used
+    put(key, value)
+        Add value to the cache, evicting the least recently used values if the cache becomes too large
+    """
+
+    def __init__(self, max_size=None, sizeof=None):
+
+        self.max_size = max_size
+        self._sizeof = sizeof if sizeof is not None else (lambda value: 1)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.size, self.hits, self.misses, self.evictions = 0, 0, 0, 0
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            self._data.move_to_end(key)
+            return self._data[key][0]
+
+    def put(self, key, value):
+        """
+        Add value to the cache. Values larger than max_size are not cached.
+        """
+
+        size = self._sizeof(value)
+
+        with self._lock:
+            if key in self._data:
+                self.size -= self._data.pop(key)[1]
+
+            if self.max_size is not None and size > self.max_size:
+                return
+
+            self._data[key] = (value, size)
+            self.size += size
+
+            while self.max_size is not None and self.size > self.max_size:
+                _, (_, evicted_size) = self._data.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    @property
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': self.size,
+            'max_size': self.max_size,
+        }
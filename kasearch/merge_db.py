@@ -1,21 +1,43 @@
-import uuid
 import glob
 import os
+import collections
 
 import numpy as np
 
+from kasearch.shard_io import find_shards, load_shard, save_shard, remove_shard, update_manifest
+from kasearch.region_index import index_arrays, region_lengths, shard_summary
+from kasearch.canonical_alignment import cdr3_mask
+from kasearch.occurrences import deduplicate_shards
 
-def merge_files(data_folder, data_file_size = 5_000_000):
+
+def merge_files(data_folder, data_file_size = 5_000_000, shard_format = 'npz', bucket_by_cdr3 = False, deduplicate = False, shard_layout = 'rows'):
     """
     Merges the files into files containing "data_file_size" of sequences. Default is 5 million.
+    
+    The merged files are saved as either compressed npz files or uncompressed npy shards (shard_format='npy'), 
+    which are memory-mapped when searched. Files with normal sequences also store the length of each region 
+    of each sequence, used to skip sequences which cannot match a query, and the residues found at each position 
+    in blocks of sequences, used to skip blocks which cannot beat the current best matches.
+    
+    With bucket_by_cdr3, each file of normal sequences only contains sequences with the same CDR3 length, 
+    so length matched searches only need to open files with the CDR3 lengths of the queries. 
+    
+    With shard_layout='columns', the canonical alignments of normal sequences are stored as a group of columns for each 
+    region, so searches of e.g. only CDR3 only read the CDR3 columns. With shard_layout='packed', they are stored 
+    with 5 bits per position instead (see kasearch.packed_encoding).
+    
+    With deduplicate, each unique canonical alignment of a normal sequence is only stored once, and the ids of all 
+    its occurrences are kept in an occurrence table of the folder (see kasearch.occurrences).
     """
     for subfolder in glob.glob(os.path.join(data_folder, '*', '*')):
 
-        normal_files = glob.glob(os.path.join(subfolder, 'data-subset-normal-*.npz'))
-        unusual_files = glob.glob(os.path.join(subfolder, 'data-subset-unusual-*.npz'))
+        normal_files = find_shards(subfolder, 'normal')
+        unusual_files = find_shards(subfolder, 'unusual')
+
+        keep = deduplicate_shards(normal_files, subfolder) if deduplicate else None
 
-        merge_subfolder(list_of_files=normal_files, save_folder=subfolder,  data_file_size=data_file_size, suffix='normal')
-        merge_subfolder(list_of_files=unusual_files, save_folder=subfolder, data_file_size=data_file_size, suffix='unusual')
+        merge_subfolder(list_of_files=normal_files, save_folder=subfolder,  data_file_size=data_file_size, suffix='normal', shard_format=shard_format, bucket_by_cdr3=bucket_by_cdr3, keep=keep, shard_layout=shard_layout)
+        merge_subfolder(list_of_files=unusual_files, save_folder=subfolder, data_file_size=data_file_size, suffix='unusual', shard_format=shard_format)
 
 def chunks(lst, n):
     """
@@ -24,13 +46,38 @@ def chunks(lst, n):
     for i in range(0, len(lst), n):
         yield lst[i:i + n]
         
-def merge_subfolder(list_of_files, save_folder, data_file_size = 5_000_000, suffix='-0-'): 
+def load_to_merge(file_name, keep=None):
+    """
+    Loads the sequences of a file to merge, only keeping the sequences selected in keep (if given for the file).
+    """
+    
+    data = load_shard(file_name, keys=['numberings', 'idxs'], mmap=False)
+    if keep is None or file_name not in keep: return data
+    
+    return {key: array[keep[file_name]] for key, array in data.items()}
+        
+def save_merged(save_folder, suffix, shard_format, numberings, idxs, shard_layout='rows'):
+    """
+    Saves a merged file, together with its index and its summary in the manifest of save_folder.
+    """
+    
+    data = {'numberings': numberings, 'idxs': idxs}
+    if suffix == 'normal': data.update(index_arrays(numberings))
+    
+    save_file = save_shard(save_folder, suffix, shard_format, shard_layout, **data)
+    update_manifest(save_file, shard_summary(data))
+        
+def merge_subfolder(list_of_files, save_folder, data_file_size = 5_000_000, suffix='-0-', shard_format='npz', bucket_by_cdr3=False, keep=None, shard_layout='rows'): 
     """
     Merges the files in a subfolder into files containing "data_file_size" of sequences. Default is 50 million.
     """
+    
+    if bucket_by_cdr3 and suffix == 'normal':
+        return merge_subfolder_by_cdr3_length(list_of_files, save_folder, data_file_size, shard_format, keep, shard_layout)
+    
     numberings, idxs, seq_counts = [], [], 0
     
-    for data, file_name in [(np.load(fname, allow_pickle=True), fname) for fname in list_of_files]:
+    for data, file_name in [(load_to_merge(fname, keep), fname) for fname in list_of_files]:
         numberings.append(data['numberings'])
         idxs.append(data['idxs'])
         seq_counts += data['idxs'].shape[0]
@@ -39,32 +86,54 @@ def merge_subfolder(list_of_files, save_folder, data_file_size = 5_000_000, suff
             for sub_numberings, sub_idxs in zip(chunks(np.concatenate(numberings), data_file_size), chunks(np.concatenate(idxs), data_file_size)):
                 
                 if sub_idxs.shape[0] == data_file_size:
-                    
-                    unique_id = str(uuid.uuid4())
-                    save_file = os.path.join(save_folder, "data-subset-{}-{}.npz".format(suffix, unique_id))
-                    np.savez_compressed(save_file, 
-                                        numberings=sub_numberings, 
-                                        idxs=sub_idxs)
+                    save_merged(save_folder, suffix, shard_format, sub_numberings, sub_idxs, shard_layout)
 
             numberings, idxs, seq_counts = [], [], 0
-            numberings.append(sub_numberings)
-            idxs.append(sub_idxs)
-            seq_counts += sub_idxs.shape[0]
+            
+            if sub_idxs.shape[0] < data_file_size: # The remainder is merged with the next files
+                numberings.append(sub_numberings)
+                idxs.append(sub_idxs)
+                seq_counts += sub_idxs.shape[0]
         
         
-        os.remove(file_name)
+        remove_shard(file_name)
         
     if seq_counts > 0:
                                 
-        unique_id = str(uuid.uuid4())
-        save_file = os.path.join(save_folder, "data-subset-{}-{}.npz".format(suffix, unique_id))                        
-        np.savez_compressed(save_file, 
-                            numberings=np.concatenate(numberings), 
-                            idxs=np.concatenate(idxs))
-
-
-
+        save_merged(save_folder, suffix, shard_format, np.concatenate(numberings), np.concatenate(idxs), shard_layout)
+        
+def merge_subfolder_by_cdr3_length(list_of_files, save_folder, data_file_size = 5_000_000, shard_format='npz', keep=None, shard_layout='rows'):
+    """
+    Merges the files in a subfolder into files containing sequences of a single CDR3 length, with at most
+    "data_file_size" sequences in each file.
+    """
     
+    buckets = collections.defaultdict(lambda: {'numberings': [], 'idxs': [], 'seq_counts': 0})
     
+    for file_name in list_of_files:
+        data = load_to_merge(file_name, keep)
+        cdr3_lengths = region_lengths(data['numberings'], cdr3_mask[None])[:, 0]
+        
+        for cdr3_length in np.unique(cdr3_lengths):
+            in_bucket = cdr3_lengths == cdr3_length
+            
+            bucket = buckets[int(cdr3_length)]
+            bucket['numberings'].append(data['numberings'][in_bucket])
+            bucket['idxs'].append(data['idxs'][in_bucket])
+            bucket['seq_counts'] += int(in_bucket.sum())
+            
+            if bucket['seq_counts'] >= data_file_size:
+                numberings, idxs = np.concatenate(bucket['numberings']), np.concatenate(bucket['idxs'])
+                n_full = (bucket['seq_counts'] // data_file_size) * data_file_size
+                
+                for sub_numberings, sub_idxs in zip(chunks(numberings[:n_full], data_file_size), chunks(idxs[:n_full], data_file_size)):
+                    save_merged(save_folder, 'normal', shard_format, sub_numberings, sub_idxs, shard_layout)
+                
+                bucket['numberings'], bucket['idxs'] = [numberings[n_full:]], [idxs[n_full:]]
+                bucket['seq_counts'] -= n_full
+                
+        remove_shard(file_name)
         
-        
\ No newline at end of file
+    for bucket in buckets.values():
+        if bucket['seq_counts'] > 0:
+            save_merged(save_folder, 'normal', shard_format, np.concatenate(bucket['numberings']), np.concatenate(bucket['idxs']), shard_layout)
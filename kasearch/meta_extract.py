@@ -1,17 +1,23 @@
 import os
 import ast
 import json
-from joblib import Parallel, delayed
-import pkg_resources
+import collections
+from contextlib import contextmanager
+from concurrent.futures.thread import ThreadPoolExecutor
 
 import pandas as pd
 import numpy as np
 
+from kasearch.meta_index import index_prefix, has_index, index_study, read_indexed_study
+from kasearch.lru_cache import LRUCache
+from kasearch.fetch import StudyFetcher, is_url
+
 
 class ExtractMetadata:
-    def __init__(self, database_path=None, local_oas_path=None):
+    def __init__(self, database_path=None, local_oas_path=None, meta_cache_size=100_000):
         
         self._set_id_to_study(database_path, local_oas_path)
+        self._set_meta_cache(meta_cache_size)
     
     def _set_id_to_study(self, database_path, local_oas_path=None):
         """
@@ -39,55 +45,209 @@ class ExtractMetadata:
         
         return np.split(idxs_ordered_by_study, split[1:])
     
-    def _get_single_study_meta(self, idxs):
+    def _study_file(self, study_id):
         """
-        Get meta for all ids from a given study.
+        Path or url of a study file.
         """
-        study_id, line_ids = idxs[0,0], idxs[:,1]
+        
         study_file = self.id_to_study[study_id]
         
-        if "opig.stats.ox.ac.uk" not in study_file: study_file = os.path.join(self.db_path, 'extra_data', study_file)
-
-        if "Bender_2020" in study_file:
-            # This is only relevant for versions of OASdb which still include Bender_2020
-            print("""Heavy chain data in Bender et al. 2020 has been removed from OAS due to contamination.
-Metadata from matches to Bender et al. 2020 sequences therefore return NaN. Either increase 'keep_best_n' 
-or use a newer OASdb.""")
-            sequence_data = pd.read_csv(pkg_resources.resource_filename(__name__, 'blank_df.csv'))
-
-            return sequence_data.reindex(list(range(len(line_ids)))).reset_index(drop=True)
-
-        sequence_meta = pd.Series(json.loads(','.join(pd.read_csv(study_file, nrows=0).columns)))
-        sequence_data = pd.read_csv(
-            study_file, 
-            header=1, 
-            skiprows=[x+2 for x in range(line_ids.max()) if x not in line_ids], 
-            nrows=len(line_ids)
-        )        
-
-        for key in sequence_meta.keys():
-            sequence_data[key] = sequence_meta[key] 
-
-        sequence_data["rank"] = idxs[np.argsort(line_ids)][:,-1]
-
+        if "opig.stats.ox.ac.uk" not in study_file and not is_url(study_file): study_file = os.path.join(self.db_path, 'extra_data', study_file)
+            
+        return study_file
+    
+    def _set_meta_cache(self, max_rows=100_000, max_studies=1_000):
+        """
+        Sets the caches of fetched meta data, i.e. the lines of sequences and the meta data of studies.
+        """
+        
+        self._meta_rows = LRUCache(max_size=max_rows)
+        self._meta_headers = LRUCache(max_size=max_studies)
+        
+    def _set_study_fetcher(self, cache_folder=None, max_size=5_000_000_000, transport=None, max_concurrent=4):
+        """
+        Sets the local mirror of remote (OAS) study files, by default in the study_cache folder of the database.
+        """
+        
+        cache_folder = cache_folder if cache_folder is not None else os.path.join(self.db_path, 'study_cache')
+        self._study_fetcher = StudyFetcher(cache_folder, max_size=max_size, transport=transport, max_concurrent=max_concurrent)
+        
+    @contextmanager
+    def _local_study_file(self, study_file):
+        """
+        Local copy of a study file, downloading remote files only once. The copy is not evicted while in the context.
+        """
+        
+        if not is_url(study_file): 
+            yield study_file
+            return
+        
+        if getattr(self, '_study_fetcher', None) is None: self._set_study_fetcher()
+        with self._study_fetcher.fetched(study_file) as local_file:
+            yield local_file
+        
+    def _meta_pool(self, n_jobs):
+        """
+        Threads used for reading studies, which are kept for later calls with the same number of threads.
+        """
+        
+        if getattr(self, '_meta_executor', None) is None or self._meta_n_jobs != n_jobs:
+            self._close_meta_pool()
+            self._meta_executor, self._meta_n_jobs = ThreadPoolExecutor(max_workers=n_jobs), n_jobs
+            
+        return self._meta_executor
+    
+    def _close_meta_pool(self):
+        
+        if getattr(self, '_meta_executor', None) is not None:
+            self._meta_executor.shutdown(wait=False)
+            self._meta_executor = None
+        
+    @property
+    def meta_cache_stats(self):
+        if not hasattr(self, '_meta_rows'): return None
+        
+        stats = {'rows': self._meta_rows.stats, 'studies': self._meta_headers.stats}
+        if getattr(self, '_study_fetcher', None) is not None: stats['downloads'] = self._study_fetcher.stats
+        return stats
+    
+    def _fetch_meta(self, idxs, n_jobs=1):
+        """
+        Fetch meta data for (study_id, line_id) ids, reading each study at most once and only the lines not already cached.
+        """
+        
+        if not hasattr(self, '_meta_rows'): self._set_meta_cache()
+        
+        headers, rows, missing = {}, {}, collections.defaultdict(list)
+        
+        ids = np.unique(np.asarray(idxs)[:, :2], axis=0).tolist()
+        study_headers = {study_id: self._meta_headers.get(study_id) for study_id in dict.fromkeys(study_id for study_id, _ in ids)}
+        
+        for study_id, line_id in ids:
+            row, header = self._meta_rows.get((study_id, line_id)), study_headers[study_id]
+            
+            if row is None or header is None:
+                missing[study_id].append(line_id)
+            else:
+                rows[(study_id, line_id)], headers[study_id] = row, header
+        
+        tasks = [(self._study_file(study_id), index_prefix(self.db_path, study_id), np.array(line_ids)) for study_id, line_ids in missing.items()]
+        
+        if n_jobs > 1 and len(tasks) > 1:
+            fetched = list(self._meta_pool(n_jobs).map(self._read_study_lines, tasks))
+        else:
+            fetched = [self._read_study_lines(task) for task in tasks]
+        
+        for (study_id, line_ids), (header, study_rows) in zip(missing.items(), fetched):
+            headers[study_id] = header
+            self._meta_headers.put(study_id, header)
+            
+            for line_id, row in zip(sorted(line_ids), study_rows):
+                rows[(study_id, line_id)] = row
+                self._meta_rows.put((study_id, line_id), row)
+                
+        return headers, rows
+    
+    def _read_study_lines(self, task):
+        study_file, prefix, line_ids = task
+        
+        if has_index(prefix) or "Bender_2020" in study_file: return _read_study_lines(study_file, prefix, line_ids)
+        
+        with self._local_study_file(study_file) as local_file:
+            return _read_study_lines(local_file, prefix, line_ids)
+    
+    def _single_study_meta(self, idxs, headers, rows):
+        """
+        Meta data for all ids from a given study, ordered by line.
+        """
+        
+        study_id, line_ids = idxs[0,0], idxs[:,1]
+        order = np.argsort(line_ids)
+        
+        sequence_data = pd.DataFrame([rows[(study_id, line_id)] for line_id in line_ids[order].tolist()])
+        
+        for key, value in headers[study_id].items():
+            sequence_data[key] = value
+            
+        sequence_data["rank"] = idxs[order][:,-1]
+        
         return sequence_data
         
-    def _extract_meta(self, idxs, n_jobs=1):
+    def _extract_meta(self, idxs, n_jobs=1, fetched=None):
         """
         Extract meta data from all ids for a given query and region.
         """
         
         idxs = [idxs] if any(isinstance(i, int) for i in idxs) else idxs
         
-        groups = self.__group_ids_by_study(idxs)
-        groups.sort(key=len, reverse=True)
+        if len(idxs) == 0: return pd.DataFrame()
+        
+        headers, rows = fetched if fetched is not None else self._fetch_meta(idxs, n_jobs=n_jobs)
         
-        n_groups = len(groups)
-        n_jobs = n_groups if n_groups <  n_jobs else n_jobs
-        chunksize= n_groups // n_jobs
+        groups = self.__group_ids_by_study(np.asarray(idxs))
+        groups.sort(key=len, reverse=True)
 
-        fetched_metadata = pd.concat(Parallel(n_jobs=n_jobs)(delayed(self._get_single_study_meta)(group) for group in groups))
+        fetched_metadata = pd.concat([self._single_study_meta(group, headers, rows) for group in groups])
         
         return fetched_metadata.sort_values("rank").reset_index(drop=True).drop(columns = ["rank"])
  
- 
+
+def _read_study_lines(study_file, prefix, line_ids):
+    """Read the study meta data and the lines of specific sequences from a study.
+
+    Returns
+    -------
+    dict, list of dict
+        Meta data of the study, and the lines ordered by line id
+    """
+
+    line_ids = np.sort(line_ids)
+
+    if "Bender_2020" in study_file:
+        # This is only relevant for versions of OASdb which still include Bender_2020
+        print("""Heavy chain data in Bender et al. 2020 has been removed from OAS due to contamination.
+Metadata from matches to Bender et al. 2020 sequences therefore return NaN. Either increase 'keep_best_n' 
+or use a newer OASdb.""")
+        sequence_data = pd.read_csv(os.path.join(os.path.dirname(__file__), 'blank_df.csv'))
+
+        return {}, sequence_data.reindex(list(range(len(line_ids)))).to_dict('records')
+
+    if has_index(prefix): # Read the lines directly from the indexed study
+        study_file = read_indexed_study(prefix, line_ids)
+        skiprows = None
+    else:
+        lines_to_keep = set((line_ids + 2).tolist())
+        skiprows = lambda x: x > 1 and x not in lines_to_keep
+
+    sequence_meta = json.loads(','.join(pd.read_csv(study_file, nrows=0).columns))
+    if hasattr(study_file, 'seek'): study_file.seek(0)
+
+    sequence_data = pd.read_csv(
+        study_file, 
+        header=1, 
+        skiprows=skiprows, 
+        nrows=len(line_ids)
+    )
+
+    return sequence_meta, sequence_data.to_dict('records')
+
+
+def build_metadata_index(database_path, local_oas_path=None):
+    """Index the study files of a database, so the meta data of the closest sequences is read directly.
+
+    Only studies available locally (in extra_data or in local_oas_path) are indexed. Indexed studies are stored 
+    uncompressed, and therefore take up more space than the original study files.
+
+    Parameters
+    ----------
+    database_path : str
+        Path to the database
+    local_oas_path : str
+        Path to a local version of OAS, for databases derived from OAS
+    """
+
+    extractor = ExtractMetadata(database_path, local_oas_path)
+
+    for study_id in extractor.id_to_study:
+        study_file = extractor._study_file(study_id)
+        if os.path.exists(study_file): index_study(study_file, index_prefix(database_path, study_id))
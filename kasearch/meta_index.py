@@ -0,0 +1,77 @@
+import io
+import os
+import gzip
+
+import numpy as np
+
+# Indexed studies are stored as an uncompressed copy of the study file, together with the byte offset of each
+# sequence (line) in the copy, so the meta data of a sequence can be read directly instead of parsing the whole study.
+meta_index_folder = 'meta_index'
+
+
+def index_prefix(database_path, study_id):
+    return os.path.join(database_path, meta_index_folder, str(study_id))
+
+
+def has_index(prefix):
+    return os.path.exists(prefix + '.npy') and os.path.exists(prefix + '.csv')
+
+
+def index_study(study_file, prefix):
+    """Index a study file, i.e. a (gzipped) csv with a line of study meta data, a header and a line per sequence.
+
+    Parameters
+    ----------
+    study_file : str
+        Path to the study file
+    prefix : str
+        Path (without extension) to save the uncompressed study (.csv) and byte offsets of its sequences (.npy) to
+    """
+
+    os.makedirs(os.path.dirname(prefix), exist_ok=True)
+    opener = gzip.open if study_file.endswith('.gz') else open
+
+    offsets, position, n_records, in_quotes = [], 0, 0, False
+
+    with opener(study_file, 'rb') as source, open(prefix + '.csv', 'wb') as target:
+        for line in source:
+            if not in_quotes:  # Start of a new record, as quoted fields can span several lines
+                if n_records >= 2 and line.strip(): offsets.append(position)
+                n_records += 1
+
+            if not line.endswith(b'\n'): line += b'\n'
+            target.write(line)
+            position += len(line)
+
+            if line.count(b'"') % 2: in_quotes = not in_quotes
+
+    offsets.append(position)
+    np.save(prefix + '.npy', np.array(offsets, np.int64))
+
+
+def read_indexed_study(prefix, line_ids):
+    """Read the study header and the lines of specific sequences from an indexed study.
+
+    Parameters
+    ----------
+    prefix : str
+        Path (without extension) of the indexed study
+    line_ids : numpy array
+        Lines (sequence numbers) to read
+
+    Returns
+    -------
+    file-like
+        The two header lines followed by the requested lines, in the given order, to parse with pd.read_csv
+    """
+
+    offsets = np.load(prefix + '.npy', mmap_mode='r')
+    starts, ends = offsets[np.asarray(line_ids)], offsets[np.asarray(line_ids) + 1]
+
+    with open(prefix + '.csv', 'rb') as handle:
+        chunks = [handle.read(int(offsets[0]))]
+        for start, end in zip(starts, ends):
+            handle.seek(int(start))
+            chunks.append(handle.read(int(end - start)))
+
+    return io.BytesIO(b''.join(chunks))
@@ -0,0 +1,203 @@
+import numpy as np
+
+from kasearch.identity_calculations import default_region_masks, default_length_matched, identity_keys, identity_key_bits, id_ranks
+from kasearch.packed_encoding import n_planes, pack_numberings
+
+# Positions are packed into the bits of 64-bit words (four for all 200 positions), so counting residues within a region is a popcount
+if hasattr(np, 'bitwise_count'):
+    _popcount = np.bitwise_count
+else:
+    _popcount_table = np.array([bin(i).count('1') for i in range(256)], np.uint8)
+
+    def _popcount(array):
+        return _popcount_table[array.view(np.uint8)].reshape(*array.shape, -1).sum(-1, dtype=np.uint8)
+
+
+def _count_bits(packed, packed_masks):
+    """
+    Count the set bits of packed positions within each packed region mask.
+    """
+
+    return np.stack([_popcount(packed & mask).sum(-1, dtype=np.int32) for mask in packed_masks], axis=-1)
+
+
+def _pack(positions):
+    packed = np.packbits(positions, axis=-1)
+    padded = np.zeros((*packed.shape[:-1], -(-packed.shape[-1] // 8) * 8), np.uint8)
+    padded[..., :packed.shape[-1]] = packed
+    return padded.view(np.uint64)
+
+
+def calculate_sequence_identities(
+    targets, queries,
+    region_masks=default_region_masks,
+    length_matched=default_length_matched,
+    include_ends=True,
+    exact=False,
+):
+    """Calculate identities between all targets and queries.
+
+    Gives the same results as the jax kernels, _calculate_single_sequence_identity_with_ends
+    and _calculate_single_sequence_identity_without_ends, including NaN for empty regions.
+
+    Parameters
+    ----------
+    targets : numpy array
+        Canonical alignments of the targets
+    queries : numpy array
+        Canonical alignments of the queries
+    region_masks : numpy array
+        Masks of the regions to calculate identities for
+    length_matched : numpy array
+        Whether each region is only compared between sequences of the same length
+    include_ends : bool
+        Whether missing ends are counted as mismatches
+    exact : bool
+        Return the integer keys of the identities (see identity_keys) instead (default is False)
+
+    Returns
+    -------
+    numpy array
+        Identities of shape (targets, queries, regions)
+    """
+
+    return _identities(
+        _pack(targets[:, None] == queries[None]), 
+        (_pack(targets != 0), _pack(targets != 124)), 
+        (_pack(queries != 0), _pack(queries != 124)), 
+        region_masks, length_matched, include_ends, exact,
+    )
+
+
+def _planes(packed_numberings):
+    """
+    Bit planes of packed alignments (see packed_encoding) as 64-bit words, of shape (sequences, planes, words).
+    """
+
+    planes = np.asarray(packed_numberings).reshape(packed_numberings.shape[0], n_planes, -1)
+    padded = np.zeros((n_planes, planes.shape[0], -(-planes.shape[-1] // 8) * 8), np.uint8)
+    padded[..., :planes.shape[-1]] = planes.transpose((1, 0, 2))
+    return padded.view(np.uint64).transpose((1, 0, 2))
+
+
+def calculate_packed_sequence_identities(
+    packed_targets, queries,
+    region_masks=default_region_masks,
+    length_matched=default_length_matched,
+    include_ends=True,
+    exact=False,
+):
+    """
+    Calculate identities between all packed targets (see packed_encoding) and queries, as calculate_sequence_identities, 
+    but without unpacking the targets. Positions hold the same residue where none of the bit planes differ, while 
+    gaps have no bits set and positions outside the sequence have all bits set.
+    """
+
+    planes1, planes2 = _planes(packed_targets), _planes(pack_numberings(queries))
+
+    same = planes1[:, None, 0] ^ planes2[None, :, 0]
+    differ = np.empty_like(same)
+    for plane in range(1, n_planes):
+        same |= np.bitwise_xor(planes1[:, None, plane], planes2[None, :, plane], out=differ)
+    np.invert(same, out=same)
+
+    return _identities(
+        same,
+        (np.bitwise_or.reduce(planes1, axis=1), ~np.bitwise_and.reduce(planes1, axis=1)),
+        (np.bitwise_or.reduce(planes2, axis=1), ~np.bitwise_and.reduce(planes2, axis=1)),
+        region_masks, length_matched, include_ends, exact,
+    )
+
+
+def _identities(same, targets_present, queries_present, region_masks, length_matched, include_ends, exact=False):
+    """
+    Identities (or their keys with exact) from packed positions, i.e. where targets and queries hold the same value (same) 
+    and where each target and query is not a gap and not outside the sequence (as a tuple of the two).
+    """
+
+    packed_masks = _pack(np.asarray(region_masks, dtype=bool))
+
+    (not_gap1, not_missing1), (not_gap2, not_missing2) = targets_present, queries_present
+    packed_exists1, packed_exists2 = not_gap1 & not_missing1, not_gap2 & not_missing2
+
+    overlap = _count_bits(same & packed_exists1[:, None] & packed_exists2[None], packed_masks)
+    len1, len2 = _count_bits(packed_exists1, packed_masks), _count_bits(packed_exists2, packed_masks)
+
+    if include_ends:
+        length = len1[:, None] + len2[None] - _count_bits(packed_exists1[:, None] & packed_exists2[None], packed_masks)
+    else:
+        length = _count_bits((not_gap1[:, None] | not_gap2[None]) & not_missing1[:, None] & not_missing2[None], packed_masks)
+
+    matched = ~np.asarray(length_matched) | (len1[:, None] == len2[None])
+    if exact:
+        return identity_keys(overlap, length, matched)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        identities = overlap.astype(np.float32) / length.astype(np.float32)
+
+    return np.where(matched, identities, np.float32(0))
+
+
+def get_n_most_identical_multiquery(
+    query, targets, target_ids, n=10,
+    region_masks=default_region_masks,
+    length_matched=default_length_matched,
+    include_ends=True,
+    query_block_size=32,
+    tile_size=4096,
+    calculate=calculate_sequence_identities,
+    exact=False,
+):
+    """
+    Find the n most identical targets for each query and region, scanning tiles of targets and
+    only keeping the n best of each. Same interface and results as the jax backend, but without jax.
+    """
+
+    n_queries, n_regions = query.shape[0], region_masks.shape[0]
+    best_identities = np.zeros((n_queries, n_regions, 0), np.int32 if exact else np.float32)
+    best_rows = np.zeros((n_queries, n_regions, 0), np.int64)
+    ranks = id_ranks(target_ids) if exact else None
+
+    for start in range(0, targets.shape[0], tile_size):
+        tile = np.asarray(targets[start:start + tile_size])
+
+        identities = np.concatenate([
+            calculate(tile, query[i:i + query_block_size], region_masks, length_matched, include_ends, exact)
+            for i in range(0, n_queries, query_block_size)
+        ], axis=1)
+        if not exact: identities[np.isnan(identities)] = 0
+        identities = identities.transpose((1, 2, 0))
+
+        best_identities = np.concatenate([best_identities, identities], axis=-1)
+        best_rows = np.concatenate([best_rows, np.broadcast_to(np.arange(start, start + tile.shape[0]), identities.shape)], axis=-1)
+
+        if best_identities.shape[-1] > n:
+            position_of_n_best = np.argpartition(_ranking(best_identities, best_rows, ranks), n - 1, axis=-1)[..., :n]
+            best_identities = np.take_along_axis(best_identities, position_of_n_best, axis=-1)
+            best_rows = np.take_along_axis(best_rows, position_of_n_best, axis=-1)
+
+    order = np.argsort(_ranking(best_identities, best_rows, ranks), axis=-1)
+
+    n_highest_identities = np.take_along_axis(best_identities, order, axis=-1)
+    n_highest_ids = np.asarray(target_ids)[np.take_along_axis(best_rows, order, axis=-1)]
+
+    return n_highest_identities.transpose((0,2,1)), n_highest_ids.transpose((0,2,1,3))
+
+
+def _ranking(identities, rows, ranks=None):
+    """
+    Values sorting the most identical targets first. With the id ranks of the targets (exact ranking), the keys are 
+    combined with the id rank of each target, so targets with the same identity are ranked by id.
+    """
+
+    if ranks is None: return -identities
+
+    return ((np.int64(1) << identity_key_bits + 1) - identities.astype(np.int64)) << 32 | ranks[rows]
+
+
+def get_n_most_identical_packed(query, packed_targets, target_ids, n=10, **options):
+    """
+    Find the n most identical packed targets (see packed_encoding) for each query and region, as get_n_most_identical_multiquery.
+    """
+
+    return get_n_most_identical_multiquery(query, packed_targets, target_ids, n=n, calculate=calculate_packed_sequence_identities, **options)
@@ -0,0 +1,229 @@
+import os
+import shutil
+
+import numpy as np
+
+from kasearch.shard_io import load_shard
+
+# A deduplicated folder of shards stores each unique canonical alignment once. The ids (file_id, line) of all
+# occurrences of sequences occurring more than once are kept in a side table of the folder, as the occurrences
+# of each representative (the id stored in the shards), ordered by the id of the representative.
+occurrences_name = 'occurrences'
+
+_hash_seeds = np.array([0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F], np.uint64)
+_hash_primes = np.array([0x100000001B3, 0xFF51AFD7ED558CCD], np.uint64)
+
+
+def sequence_hashes(numberings):
+    """
+    128 bit hashes of canonical alignments, as an array of shape (sequences, 2).
+    """
+
+    words = np.ascontiguousarray(numberings, dtype=np.int8).view(np.uint64)
+
+    hashes = np.repeat(_hash_seeds[None], words.shape[0], axis=0)
+    for num in range(words.shape[1]):
+        hashes = (hashes ^ words[:, num, None]) * _hash_primes
+
+    return hashes ^ (hashes >> np.uint64(29))
+
+
+def group_sequences(hashes):
+    """
+    Group sequences with identical hashes, returning the group of each sequence and the first sequence of each group. 
+    Sequences with different canonical alignments are only in the same group if their hashes collide, see split_collisions.
+    """
+
+    order = np.lexsort((hashes[:, 1], hashes[:, 0])) # Stable, so identical sequences keep their order
+    sorted_hashes = hashes[order]
+
+    new_group = np.ones(order.shape[0], bool)
+    new_group[1:] = (sorted_hashes[1:] != sorted_hashes[:-1]).any(1)
+
+    groups = np.empty(order.shape[0], np.int64)
+    groups[order] = np.cumsum(new_group) - 1
+
+    return groups, order[new_group]
+
+
+def split_collisions(groups, representatives, numbering_chunks):
+    """
+    Split groups of sequences with the same hash but different canonical alignments (hash collisions), comparing 
+    each sequence with the first sequence of its group. The canonical alignments are given as consecutive chunks, 
+    so they do not need to be loaded at once. Sequences differing from their group are regrouped by their canonical 
+    alignment, as new groups after the existing ones.
+    """
+
+    groups = groups.copy()
+    first_numberings, collided, collided_numberings = None, [], []
+
+    start = 0
+    for numberings in numbering_chunks:
+        numberings = np.asarray(numberings)
+        stop = start + numberings.shape[0]
+        if first_numberings is None: first_numberings = np.zeros((representatives.shape[0], numberings.shape[1]), numberings.dtype)
+
+        # The first sequence of a group is never in a later chunk than the others
+        in_chunk = representatives[(representatives >= start) & (representatives < stop)]
+        first_numberings[groups[in_chunk]] = numberings[in_chunk - start]
+
+        differ = (numberings != first_numberings[groups[start:stop]]).any(1)
+        collided.append(np.nonzero(differ)[0] + start)
+        collided_numberings.append(numberings[differ])
+        start = stop
+
+    collided = np.concatenate(collided) if collided else np.zeros(0, np.int64)
+    if collided.shape[0] == 0: return groups, representatives
+
+    # Identical canonical alignments have the same hash, so the collided sequences can be grouped on their own
+    _, first, inverse = np.unique(np.concatenate(collided_numberings), axis=0, return_index=True, return_inverse=True)
+    groups[collided] = representatives.shape[0] + inverse.reshape(-1)
+
+    return groups, np.concatenate([representatives, collided[first]])
+
+
+def unique_sequences(numberings):
+    """
+    Indexes of the first occurrence of each unique canonical alignment, in the order they occur.
+    """
+
+    groups, representatives = split_collisions(*group_sequences(sequence_hashes(numberings)), [numberings])
+    return np.sort(representatives)
+
+
+def id_codes(idxs):
+    """
+    Ids (file_id, line) encoded as single integers, ordered by file_id and then line.
+    """
+
+    idxs = np.asarray(idxs, np.int64).reshape(-1, 2)
+    return (idxs[:, 0] << 32) | idxs[:, 1]
+
+
+def read_occurrences(folder):
+    """
+    Read the occurrence table of a folder, returning None if the folder is not deduplicated.
+    """
+
+    table_folder = os.path.join(folder, occurrences_name)
+    if not os.path.isdir(table_folder): return None
+
+    return load_shard(table_folder)
+
+
+def save_occurrences(folder, representatives, starts, occurrences):
+    """
+    Save the occurrence table of a folder, i.e. the occurrences[starts[i]:starts[i+1]] of each representatives[i].
+    """
+
+    table_folder = os.path.join(folder, occurrences_name)
+    if os.path.isdir(table_folder): shutil.rmtree(table_folder)
+    os.makedirs(table_folder)
+
+    for key, array in [('representatives', representatives), ('starts', starts), ('occurrences', occurrences)]:
+        np.save(os.path.join(table_folder, f"{key}.npy"), array)
+
+
+def expand_occurrences(tables, idxs):
+    """Ids of all occurrences of sequences.
+
+    Parameters
+    ----------
+    tables : list of dict
+        Occurrence tables of the folders the sequences are stored in
+    idxs : numpy array
+        Ids (file_id, line) of the sequences, as stored in the shards
+
+    Returns
+    -------
+    tuple of numpy arrays
+        Ids of the occurrences, and the index in idxs of the sequence each occurrence belongs to. Sequences
+        without an entry in the tables only occur once.
+    """
+
+    idxs = np.asarray(idxs, np.int32).reshape(-1, 2)
+    codes = id_codes(idxs)
+
+    in_table = np.full(idxs.shape[0], -1)
+    starts = np.zeros(idxs.shape[0], np.int64)
+    counts = np.ones(idxs.shape[0], np.int64)
+
+    for num, table in enumerate(tables):
+        representative_codes = id_codes(table['representatives'])
+        if representative_codes.shape[0] == 0: continue
+
+        position = np.minimum(np.searchsorted(representative_codes, codes), representative_codes.shape[0] - 1)
+        found = representative_codes[position] == codes
+
+        table_starts = np.asarray(table['starts'])
+        in_table[found] = num
+        starts[found] = table_starts[position[found]]
+        counts[found] = table_starts[position[found] + 1] - starts[found]
+
+    owners = np.repeat(np.arange(idxs.shape[0]), counts)
+    within = np.arange(owners.shape[0]) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    occurrences = idxs[owners]
+    for num, table in enumerate(tables):
+        from_table = in_table[owners] == num
+        if from_table.any():
+            occurrences[from_table] = table['occurrences'][starts[owners[from_table]] + within[from_table]]
+
+    return occurrences, owners
+
+
+def deduplicate_shards(files, folder):
+    """Find the unique canonical alignments in shards, updating the occurrence table of their folder.
+
+    The first occurrence of each canonical alignment is its representative, which is kept in the shards, while the
+    ids of all its occurrences, including those of earlier deduplications of the folder, are added to the table.
+
+    Parameters
+    ----------
+    files : list of str
+        Shards of normal sequences in folder
+    folder : str
+        Folder of the shards
+
+    Returns
+    -------
+    dict
+        Which sequences of each file to keep, as boolean arrays
+    """
+
+    if not files: return {}
+
+    hashes, idxs = [], []
+    for file in files:
+        data = load_shard(file, keys=['numberings', 'idxs'])
+        hashes.append(sequence_hashes(data['numberings']))
+        idxs.append(np.asarray(data['idxs'], np.int32))
+
+    lengths = [file_idxs.shape[0] for file_idxs in idxs]
+    hashes, idxs = np.concatenate(hashes), np.concatenate(idxs)
+
+    table = read_occurrences(folder)
+    occurrences, owners = expand_occurrences([table] if table is not None else [], idxs)
+
+    numbering_chunks = (load_shard(file, keys=['numberings'])['numberings'] for file in files)
+    groups, representatives = split_collisions(*group_sequences(hashes), numbering_chunks)
+
+    keep = np.zeros(idxs.shape[0], bool)
+    keep[representatives] = True
+
+    # Occurrences of each group in the order of their sequences, for the groups occurring more than once
+    occurrence_groups = groups[owners]
+    occurrences = occurrences[np.argsort(occurrence_groups, kind='stable')]
+    group_counts = np.bincount(occurrence_groups, minlength=representatives.shape[0])
+    group_starts = np.cumsum(group_counts) - group_counts
+
+    duplicated = np.nonzero(group_counts > 1)[0]
+    duplicated = duplicated[np.argsort(id_codes(idxs[representatives[duplicated]]))]
+
+    counts = group_counts[duplicated]
+    table_starts = np.concatenate([[0], np.cumsum(counts)])
+    gather = np.repeat(group_starts[duplicated] - table_starts[:-1], counts) + np.arange(table_starts[-1])
+
+    save_occurrences(folder, idxs[representatives[duplicated]], table_starts, occurrences[gather])
+
+    return dict(zip(files, np.split(keep, np.cumsum(lengths)[:-1])))
@@ -0,0 +1,70 @@
+import numpy as np
+
+from kasearch.canonical_alignment import canonical_numbering_len
+
+# Canonical alignments store each position as a byte: the ASCII code of the residue, 0 for gaps and 124 for positions
+# outside the sequence. These fit in 5 bits (0 for gaps, 1-26 for A-Z and 31 for outside), so packed alignments store
+# each bit of the codes as a separate plane of bits (one bit per position), i.e. 5 x 25 bytes instead of 200 bytes.
+# Positions of two sequences hold the same residue where none of their planes differ.
+n_planes = 5
+gap_code, outside_code = 0, 31
+
+_codes = np.full(256, -1, np.int16)
+_codes[0] = gap_code
+_codes[ord('A'):ord('Z') + 1] = np.arange(1, 27)
+_codes[124] = outside_code
+
+_symbols = np.zeros(32, np.int8)
+_symbols[1:27] = np.arange(ord('A'), ord('Z') + 1)
+_symbols[outside_code] = 124
+
+
+def packable(numberings):
+    """
+    Whether all positions of canonical alignments can be packed, i.e. only hold gaps, A-Z or are outside the sequence.
+    """
+
+    return bool((_codes[np.asarray(numberings).view(np.uint8)] >= 0).all())
+
+
+def pack_numberings(numberings, chunk_size=1_000_000):
+    """Pack canonical alignments into 5 bit planes.
+
+    Parameters
+    ----------
+    numberings : numpy array
+        Canonical alignments of shape (sequences, positions), which need to be packable
+
+    Returns
+    -------
+    numpy array
+        Packed alignments of shape (sequences, 5 * bytes per plane), as uint8
+    """
+
+    numberings = np.asarray(numberings)
+    assert packable(numberings), "Only alignments of gaps and residues A-Z can be packed."
+
+    packed = []
+    for start in range(0, max(numberings.shape[0], 1), chunk_size):
+        codes = _codes[numberings[start:start + chunk_size].view(np.uint8)]
+        planes = ((codes[:, None, :] >> np.arange(n_planes)[None, :, None]) & 1).astype(bool)
+        packed.append(np.packbits(planes, axis=-1).reshape(codes.shape[0], -1))
+
+    return np.concatenate(packed)
+
+
+def unpack_numberings(packed, n_positions=canonical_numbering_len, chunk_size=1_000_000):
+    """
+    Canonical alignments (as int8) of packed alignments.
+    """
+
+    packed = np.asarray(packed)
+
+    numberings = []
+    for start in range(0, max(packed.shape[0], 1), chunk_size):
+        chunk = packed[start:start + chunk_size]
+        planes = np.unpackbits(chunk.reshape(chunk.shape[0], n_planes, -1), axis=-1, count=n_positions)
+        codes = (planes.astype(np.uint8) << np.arange(n_planes, dtype=np.uint8)[None, :, None]).sum(1)
+        numberings.append(_symbols[codes])
+
+    return np.concatenate(numberings)
@@ -4,11 +4,14 @@ from multiprocessing import Pool
 
 import pandas as pd
 import numpy as np
-import uuid
 import shutil
 
-from kasearch import PrepareDB
+from kasearch.prepare_db import PrepareDB
 from kasearch.merge_db import merge_files
+from kasearch.shard_io import find_shards, load_shard, save_shard
+from kasearch.region_index import index_arrays
+from kasearch.meta_index import index_study, index_prefix
+from kasearch.occurrences import unique_sequences
 
     
 class PrepareOASdb:
@@ -116,11 +119,21 @@ class PrepareOASdb:
         
 
 
-    def __call__(self, data_file_size = 50_000_000):
+    def index_metadata(self):
+        """
+        Index the local OAS files, so the meta data of the closest sequences is read directly instead of downloaded.
+        """
+        
+        for num, data_file in self.data_unit_files:
+            index_study(data_file, index_prefix(self.final_db_folder, num))
+
+    def __call__(self, data_file_size = 50_000_000, shard_format = 'npz', bucket_by_cdr3 = False, index_metadata = False, deduplicate = False, shard_layout = 'rows'):
 
         self.process_many_files()
 
-        merge_files(self.final_db_folder, data_file_size = data_file_size) # Merge folders into sets of 50 million sequences
+        merge_files(self.final_db_folder, data_file_size = data_file_size, shard_format = shard_format, bucket_by_cdr3 = bucket_by_cdr3, deduplicate = deduplicate, shard_layout = shard_layout) # Merge folders into sets of 50 million sequences
+        
+        if index_metadata: self.index_metadata() # Uncompressed copies of all used OAS files take up a lot of space
     
         
 
@@ -158,7 +171,7 @@ def unflatten(xss):
 
     
     
-def prepare_tiny_oas(final_db_folder, oasdb_small_folder):
+def prepare_tiny_oas(final_db_folder, oasdb_small_folder, shard_format = 'npz'):
     """
     Codebase for creating tiny OAS, a clean set of full human antibody variable domains.
     """
@@ -172,8 +185,8 @@ def prepare_tiny_oas(final_db_folder, oasdb_small_folder):
     
     numberings = []
     idxs = []
-    for file in glob.glob(os.path.join(oasdb_small_folder, "Heavy/Human/*normal*")):
-        data = np.load(file, allow_pickle=True)
+    for file in find_shards(os.path.join(oasdb_small_folder, "Heavy", "Human"), 'normal'):
+        data = load_shard(file, keys=['numberings', 'idxs'], mmap=False)
         numberings.append(data['numberings'])
         idxs.append(data['idxs']) 
 
@@ -181,17 +194,19 @@ def prepare_tiny_oas(final_db_folder, oasdb_small_folder):
     numberings = np.concatenate(numberings)
     idxs = np.concatenate(idxs)
     
-    tmp_df = pd.DataFrame(numberings, columns=[f"col_{i}" for i in range(200)], dtype=np.int8).query("col_0!=0")
-    print("OAS small size", tmp_df.shape)
-    tmp_df = tmp_df.query("col_0!=124")
-    print("# full abs", tmp_df.shape)
+    print("OAS small size", numberings.shape)
+    full = np.nonzero((numberings[:, 0] != 0) & (numberings[:, 0] != 124))[0]
+    print("# full abs", full.shape)
 
-    tmp_df = tmp_df.drop_duplicates()
-    print("# unique abs", tmp_df.shape)
+    unique = full[unique_sequences(numberings[full])]
+    print("# unique abs", unique.shape)
     
-    for set_of_idxs in np.array_split(tmp_df.index, 10):
-        np.savez_compressed(
-            os.path.join(final_db_folder, "Heavy", "Human", f"data-subset-normal-{uuid.uuid4()}.npz"), 
+    for set_of_idxs in np.array_split(unique, 10):
+        save_shard(
+            os.path.join(final_db_folder, "Heavy", "Human"), 
+            'normal', 
+            shard_format, 
             numberings=numberings[set_of_idxs], 
-            idxs=idxs[set_of_idxs]
+            idxs=idxs[set_of_idxs],
+            **index_arrays(numberings[set_of_idxs])
         )
\ No newline at end of file
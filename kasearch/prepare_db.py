@@ -1,6 +1,5 @@
 import os
 import shutil
-import uuid
 import collections
 from dataclasses import dataclass
 from multiprocessing import Pool
@@ -8,8 +7,10 @@ from multiprocessing import Pool
 import numpy as np
 import pandas as pd
 
-from kasearch import AlignSequences
+from kasearch.align_sequences import AlignSequences
 from kasearch.merge_db import merge_files
+from kasearch.shard_io import save_shard
+from kasearch.meta_extract import build_metadata_index
     
     
 class TemporaryDataHolder:
@@ -55,14 +56,14 @@ class TemporaryDataHolder:
         os.makedirs(save_folder, exist_ok=True)    
         
         if self.sequences[chain][species] != []:
-            np.savez_compressed(file = os.path.join(save_folder, f"data-subset-normal-{uuid.uuid4()}.npz"), 
-                                numberings = np.concatenate(self.sequences[chain][species]), 
-                                idxs = np.concatenate(self.sequences_idxs[chain][species]))
+            save_shard(save_folder, 'normal', 
+                       numberings = np.concatenate(self.sequences[chain][species]), 
+                       idxs = np.concatenate(self.sequences_idxs[chain][species]))
         
         if self.unusual_sequences[chain][species] != []:
-            np.savez_compressed(file = os.path.join(save_folder, f"data-subset-unusual-{uuid.uuid4()}.npz"), 
-                                numberings = np.concatenate(self.unusual_sequences[chain][species]), 
-                                idxs = np.concatenate(self.unusual_sequences_idxs[chain][species]))
+            save_shard(save_folder, 'unusual', 
+                       numberings = np.concatenate(self.unusual_sequences[chain][species]), 
+                       idxs = np.concatenate(self.unusual_sequences_idxs[chain][species]))
         
         self.set_empty_nested_dict(chain, species)
         
@@ -74,17 +75,59 @@ class TemporaryDataHolder:
                 
             
 class PrepareDB(TemporaryDataHolder):
+    """
+    Prepares a custom database for KA-Search.
     
-    def __init__(self, db_path, n_jobs=1, from_scratch=False, from_oas=False):
+    Sequence files are read in chunks of chunk_size sequences, which are numbered and aligned by a pool of n_jobs 
+    processes kept for all files. At most two chunks per process are read ahead, and aligned sequences are saved 
+    to disk every sequences_per_subset sequences, so memory use does not depend on the size of the files.
+    """
+    
+    def __init__(self, db_path, n_jobs=1, from_scratch=False, from_oas=False, chunk_size=10_000, sequences_per_subset=4_000_000):
         super().__init__()
         
         self.db_path, self.n_jobs, self.from_oas = db_path, n_jobs, from_oas
+        self.chunk_size, self.sequences_per_subset = chunk_size, sequences_per_subset
+        self._pool = None
         
         if from_scratch and os.path.exists(db_path): shutil.rmtree(db_path)
         
         os.makedirs(db_path, exist_ok=True)
         self.id_to_study = {}
         
+    def close(self):
+        """
+        Shut down the processes used for aligning sequences.
+        """
+        
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+            
+    def _align_chunks(self, chunks, **align_kwargs):
+        """
+        Align chunks of sequences in parallel, yielding them in order while only reading a few chunks ahead.
+        """
+        
+        if self.n_jobs == 1:
+            for chunk in chunks: yield chunk, _align_chunk(chunk, **align_kwargs)
+            return
+        
+        if self._pool is None: self._pool = Pool(processes=self.n_jobs)
+        
+        queue = collections.deque()
+        for chunk in chunks:
+            queue.append((chunk, self._pool.apply_async(_align_chunk, (chunk,), align_kwargs)))
+            
+            if len(queue) >= 2 * self.n_jobs:
+                chunk, result = queue.popleft()
+                yield chunk, result.get()
+                
+        while queue:
+            chunk, result = queue.popleft()
+            yield chunk, result.get()
+        
     def prepare_sequences(
         self, 
         sequence_file, 
@@ -108,39 +151,57 @@ class PrepareDB(TemporaryDataHolder):
             self.id_to_study[file_id] = os.path.basename(sequence_file)
         
         if sequence_numberings is None:
-            sequences = pd.read_csv(sequence_file, header=1, usecols=[seq_column_name]).iloc[:,0].values
+            chunks = (
+                chunk.iloc[:,0].values 
+                for chunk in pd.read_csv(sequence_file, header=1, usecols=[seq_column_name], chunksize=self.chunk_size)
+            )
         else:
-            sequences = sequence_numberings
-        
+            chunks = (sequence_numberings[i:i+self.chunk_size] for i in range(0, len(sequence_numberings), self.chunk_size))
         
         anarci_species = [species] if species != 'Any' else ['Human', 'Mouse']
+        
+        n_sequences = 0
+        for sequences, sequence_alignments in self._align_chunks(chunks, allowed_species=anarci_species, from_oas=self.from_oas, strict=strict):
             
-        sequence_alignments = AlignSequences(
-            n_jobs=self.n_jobs, 
-            allowed_species=anarci_species,
-            from_oas=self.from_oas, 
-            strict=strict
-        )(sequences)
-        
-        if not sequence_line_idx: sequence_line_idx = range(len(sequences))
-
-        sequence_idxs = np.array([[file_id, i] for i in sequence_line_idx], np.int32)
+            if sequence_line_idx is None or len(sequence_line_idx) == 0:
+                chunk_line_idx = range(n_sequences, n_sequences + len(sequences))
+            else:
+                chunk_line_idx = sequence_line_idx[n_sequences:n_sequences + len(sequences)]
+            n_sequences += len(sequences)
+            
+            sequence_idxs = np.array([[file_id, i] for i in chunk_line_idx], np.int32)
         
-        self.add_to_prepared_data(chain, species, sequences, sequence_alignments, sequence_idxs)
+            self.add_to_prepared_data(chain, species, sequences, sequence_alignments, sequence_idxs)
         
-        if self.sequences_count[chain][species]>4_000_000:
-            self.save_data_subset(chain, species)            
+            if self.sequences_count[chain][species] > self.sequences_per_subset:
+                self.save_data_subset(chain, species)            
             
-    def finalize_prepared_files(self, prepared_file_size = 5_000_000):
+    def finalize_prepared_files(self, prepared_file_size = 5_000_000, shard_format = 'npz', bucket_by_cdr3 = False, index_metadata = False, deduplicate = False, shard_layout = 'rows'):
+        """
+        Saves the remaining sequences and merges all files into the final database. 
+        
+        With shard_format='npy' the database is saved uncompressed, so it can be memory-mapped when searched.
+        With bucket_by_cdr3 each file only holds sequences of one CDR3 length (see merge_files).
+        With index_metadata the sequence files in extra_data are indexed, so their meta data can be read directly.
+        With shard_layout='columns' the sequences are stored as groups of columns, so region searches only read their columns.
+        With shard_layout='packed' the sequences are stored with 5 bits per position, cutting their size by 37.5%.
+        With deduplicate each unique canonical alignment is only stored (and searched) once (see merge_files).
+        """
         
         self.save_data_all()
+        self.close()
         
-        merge_files(self.db_path, data_file_size = prepared_file_size)
+        merge_files(self.db_path, data_file_size = prepared_file_size, shard_format = shard_format, bucket_by_cdr3 = bucket_by_cdr3, deduplicate = deduplicate, shard_layout = shard_layout)
         
         with open(os.path.join(self.db_path, "id_to_study.txt"), "w") as handle: 
             handle.write(str(self.id_to_study))
             
-            
-            
-            
-            
+        if index_metadata: build_metadata_index(self.db_path)
+
+
+def _align_chunk(sequences, allowed_species=['Human', 'Mouse'], from_oas=False, strict=False):
+    """
+    Canonical alignment of a chunk of sequences, run by the processes of PrepareDB.
+    """
+    
+    return AlignSequences(n_jobs=1, allowed_species=allowed_species, from_oas=from_oas, strict=strict)(sequences)
@@ -0,0 +1,240 @@
+import numpy as np
+
+from kasearch.identity_calculations import default_region_masks
+from kasearch.canonical_alignment import canonical_numbering_len
+from kasearch.packed_encoding import unpack_numberings
+
+# Regions whose lengths are stored for each sequence in a shard (whole, cdrs and cdr3)
+indexed_region_masks = default_region_masks
+
+
+def _exists(numberings):
+    return (numberings != 0) & (numberings != 124)
+
+
+def region_lengths(numberings, region_masks=indexed_region_masks, chunk_size=1_000_000):
+    """Number of residues in each region of each sequence.
+
+    Parameters
+    ----------
+    numberings : numpy array
+        Canonical alignments of the sequences
+    region_masks : numpy array
+        Masks of the regions
+
+    Returns
+    -------
+    numpy array
+        Region lengths of shape (sequences, regions)
+    """
+
+    masks = np.asarray(region_masks, dtype=np.uint8).T
+
+    return np.concatenate([
+        _exists(np.asarray(numberings[i:i + chunk_size])).view(np.uint8) @ masks
+        for i in range(0, numberings.shape[0], chunk_size)
+    ] or [np.zeros((0, masks.shape[1]), np.uint8)])
+
+
+# Number of sequences summarised together in the residue bitsets of a shard
+summary_block_size = 4096
+
+
+def residue_bits(numberings):
+    """
+    Bitset of the residue at each position, with bit (residue - 65) set for A-Z, bit 31 for any other residue and no bits for gaps and missing ends.
+    """
+
+    numberings = np.asarray(numberings).astype(np.int64)
+    letter = (numberings >= 65) & (numberings <= 90)
+
+    bits = np.where(letter, np.left_shift(1, np.clip(numberings - 65, 0, 30)), 1 << 31)
+    return np.where(_exists(numberings), bits, 0).astype(np.uint32)
+
+
+def block_residues(numberings, block_size=summary_block_size, chunk_size=64):
+    """Residues found at each position within each block of sequences.
+
+    Parameters
+    ----------
+    numberings : numpy array
+        Canonical alignments of the sequences
+    block_size : int
+        Number of sequences in each block
+
+    Returns
+    -------
+    numpy array
+        Residue bitsets (see residue_bits) of shape (blocks, positions)
+    """
+
+    rows = block_size * chunk_size
+
+    return np.concatenate([
+        np.bitwise_or.reduceat(residue_bits(numberings[i:i + rows]), np.arange(0, min(rows, numberings.shape[0] - i), block_size), axis=0)
+        for i in range(0, numberings.shape[0], rows)
+    ] or [np.zeros((0, numberings.shape[1]), np.uint32)])
+
+
+def index_arrays(numberings):
+    """
+    Side index saved together with the numberings of a shard.
+    """
+
+    return {'region_lengths': region_lengths(numberings), 'block_residues': block_residues(numberings)}
+
+
+def shard_summary(data):
+    """
+    Summary of a shard saved in the manifest, i.e. its number of sequences and the range of each indexed region length.
+    """
+
+    summary = {'n_sequences': int(data['idxs'].shape[0])}
+
+    if 'region_lengths' in data and data['region_lengths'].shape[0] > 0:
+        summary['region_lengths'] = np.stack([data['region_lengths'].min(0), data['region_lengths'].max(0)], axis=-1).tolist()
+
+    return summary
+
+
+def _indexed_region(mask):
+    indexed = np.flatnonzero((indexed_region_masks == mask).all(-1))
+    return indexed[0] if indexed.size else None
+
+
+def _target_numberings(data):
+    return data['numberings'] if 'numberings' in data else unpack_numberings(data['packed_numberings'])
+
+
+def target_region_lengths(data, region_masks):
+    """
+    Region lengths of the sequences in a shard, using its stored index for indexed regions. The numberings 
+    of shards loaded with only some positions (see load_shard) have the loaded positions in data['columns'],
+    while packed numberings are unpacked if needed.
+    """
+
+    region_masks = np.asarray(region_masks)
+    loaded_masks = region_masks[:, data['columns']] if 'columns' in data else region_masks
+
+    if 'region_lengths' not in data:
+        return region_lengths(_target_numberings(data), loaded_masks)
+
+    lengths = []
+    for mask, loaded_mask in zip(region_masks, loaded_masks):
+        indexed = _indexed_region(mask)
+        lengths.append(data['region_lengths'][:, indexed] if indexed is not None else region_lengths(_target_numberings(data), loaded_mask[None])[:, 0])
+
+    return np.stack(lengths, axis=-1)
+
+
+def length_filter(query, data, region_masks, length_matched):
+    """Find sequences in a shard which can be identical to at least one query in at least one region.
+
+    When all regions are length matched, sequences with a different length than all queries in every region
+    have an identity of zero and do not need to be compared.
+
+    Returns
+    -------
+    numpy array, None
+        Boolean mask of the sequences to compare, or None if all sequences need to be compared
+    """
+
+    if not np.all(length_matched):
+        return None
+
+    query_lengths = region_lengths(query, region_masks)
+    target_lengths = target_region_lengths(data, region_masks)
+
+    keep = np.zeros(target_lengths.shape[0], dtype=bool)
+    for num, _ in enumerate(region_masks):
+        keep |= np.isin(target_lengths[:, num], query_lengths[:, num])
+
+    return keep
+
+
+def summary_filter(query, summaries, region_masks, length_matched):
+    """Find shards which can contain sequences identical to at least one query in at least one region.
+
+    Uses the range of region lengths in the summary of each shard (see shard_summary). Shards without
+    a summary, or searches with regions that are not length matched, are never filtered.
+
+    Returns
+    -------
+    numpy array
+        Boolean mask of the shards to search
+    """
+
+    keep = np.ones(len(summaries), dtype=bool)
+    if not np.all(length_matched): return keep
+
+    query_lengths = region_lengths(query, region_masks)
+    indexed = [_indexed_region(mask) for mask in region_masks]
+
+    for num, summary in enumerate(summaries):
+        if summary is None or 'region_lengths' not in summary: continue
+
+        ranges = np.array(summary['region_lengths'])
+        keep[num] = any(
+            index is None or np.any((query_lengths[:, region] >= ranges[index, 0]) & (query_lengths[:, region] <= ranges[index, 1]))
+            for region, index in enumerate(indexed)
+        )
+
+    return keep
+
+
+def identity_bound(query, data, region_masks, length_matched, include_ends, query_block_size=32):
+    """Upper bound of the identity between each query and any sequence in each block of a shard.
+
+    With include_ends, the overlap of a query of length q and a sequence of length t is at most the number 
+    of query residues found at the same positions in the block (O) and at most min(q, t), while the number 
+    of compared positions is at least max(q, t). The bound is then min(O, t)/max(q, t), which is highest for 
+    the length t in the block closest to q. Without ends, the bound is only zero or one. Length matched 
+    regions have a bound of zero in blocks without sequences of the same length as the query.
+
+    The residues found are compared for query_block_size queries at a time, so memory scales with the number
+    of blocks and queries rather than also with the number of positions.
+
+    Returns
+    -------
+    numpy array, None
+        Bounds of shape (blocks, queries, regions), or None if the shard has no block summaries
+    """
+
+    n_sequences = data['idxs'].shape[0]
+    if n_sequences == 0 or 'block_residues' not in data or data['block_residues'].shape[0] != -(-n_sequences // summary_block_size):
+        return None
+
+    masks = np.asarray(region_masks, dtype=np.float32).T
+    query_lengths = region_lengths(query, region_masks).astype(np.float32)
+
+    block_residues, query_bits = np.asarray(data['block_residues']), residue_bits(query)
+    overlap = np.zeros((block_residues.shape[0], query_bits.shape[0], masks.shape[1]), np.float32)
+    for i in range(0, query_bits.shape[0], query_block_size):
+        found = (block_residues[:, None] & query_bits[None, i:i + query_block_size]) != 0
+        overlap[:, i:i + query_block_size] = found.astype(np.float32) @ masks
+
+    # Range of lengths in each block, using the stored region lengths for indexed regions
+    block_starts = np.arange(0, n_sequences, summary_block_size)
+    min_lengths = np.zeros((block_starts.shape[0], len(region_masks)), np.float32)
+    n_positions = data['numberings'].shape[1] if 'numberings' in data else canonical_numbering_len
+    max_lengths = np.full((block_starts.shape[0], len(region_masks)), n_positions, np.float32)
+
+    for num, mask in enumerate(region_masks):
+        indexed = _indexed_region(mask)
+        if indexed is None or 'region_lengths' not in data: continue
+        lengths = np.asarray(data['region_lengths'][:, indexed])
+        min_lengths[:, num] = np.minimum.reduceat(lengths, block_starts)
+        max_lengths[:, num] = np.maximum.reduceat(lengths, block_starts)
+
+    min_lengths, max_lengths = min_lengths[:, None], max_lengths[:, None]
+
+    if include_ends:
+        closest_length = np.clip(query_lengths[None], min_lengths, max_lengths)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            bound = np.minimum(overlap, closest_length) / np.maximum(query_lengths[None], closest_length)
+        bound = np.nan_to_num(bound)
+    else:
+        bound = (overlap > 0).astype(np.float32)
+
+    possible_length = (query_lengths[None] >= min_lengths) & (query_lengths[None] <= max_lengths)
+    return np.where(~np.asarray(length_matched) | possible_length, bound, np.float32(0))
@@ -0,0 +1,255 @@
+import os
+import glob
+import json
+import uuid
+import shutil
+
+import numpy as np
+
+from kasearch.region_index import index_arrays, shard_summary
+from kasearch.canonical_alignment import canonical_numbering
+from kasearch.packed_encoding import packable, pack_numberings, unpack_numberings
+
+# Shards are either stored as compressed npz files (the original format) or as uncompressed
+# folders with a npy file per array, which can be memory-mapped instead of decompressed.
+shard_formats = ['npz', 'npy']
+raw_shard_extension = '.shard'
+
+# Canonical alignments of normal sequences are either stored as rows (the original layout), as groups of columns,
+# one for each IMGT region, so searches of a region only read (and decompress) the columns of the region, or as
+# packed rows using 5 bits per position (see packed_encoding), which are compared without unpacking them.
+shard_layouts = ['rows', 'columns', 'packed']
+_position_numbers = np.array([int(label[:-1]) for label in canonical_numbering])
+column_groups = {
+    f"columns_{name}": np.flatnonzero((_position_numbers >= first) & (_position_numbers <= last))
+    for name, first, last in [
+        ('fwr1', 1, 26), ('cdr1', 27, 38), ('fwr2', 39, 55), ('cdr2', 56, 65), ('fwr3', 66, 104), ('cdr3', 105, 117), ('fwr4', 118, 128)
+    ]
+}
+
+
+def save_shard(save_folder, suffix='normal', shard_format='npz', shard_layout='rows', **arrays):
+    """Save arrays as a new shard in save_folder.
+
+    Parameters
+    ----------
+    save_folder : str
+        Folder to save the shard in
+    suffix : str
+        Type of shard, either normal or unusual
+    shard_format : str
+        Either npz (compressed) or npy (uncompressed and memory-mappable)
+    shard_layout : str
+        Either rows, columns (the numberings of normal sequences are stored as groups of columns) or packed (the 
+        numberings of normal sequences are packed, unless they contain residues other than A-Z)
+    arrays : numpy arrays
+        Arrays to save, i.e. numberings and idxs
+
+    Returns
+    -------
+    str
+        Path to the saved shard
+    """
+
+    assert shard_format in shard_formats, f"shard_format needs to be one of {shard_formats}, not {shard_format}."
+    assert shard_layout in shard_layouts, f"shard_layout needs to be one of {shard_layouts}, not {shard_layout}."
+    
+    if shard_layout == 'columns' and suffix == 'normal':
+        numberings = arrays.pop('numberings')
+        arrays.update({key: np.ascontiguousarray(numberings[:, columns]) for key, columns in column_groups.items()})
+
+    if shard_layout == 'packed' and suffix == 'normal' and packable(arrays['numberings']):
+        arrays['packed_numberings'] = pack_numberings(arrays.pop('numberings'))
+
+    save_file = os.path.join(save_folder, f"data-subset-{suffix}-{uuid.uuid4()}")
+
+    if shard_format == 'npz':
+        save_file += '.npz'
+        np.savez_compressed(save_file, **arrays)
+    else:
+        save_file += raw_shard_extension
+        os.makedirs(save_file)
+        for key, array in arrays.items():
+            np.save(os.path.join(save_file, f"{key}.npy"), array)
+
+    return save_file
+
+
+def load_shard(file, keys=None, mmap=True, columns=None, packed=False):
+    """Load arrays from a shard.
+
+    Parameters
+    ----------
+    file : str
+        Path to a npz shard or a raw shard folder
+    keys : list of str
+        Arrays to load, skipping those not in the shard (default is all arrays in the shard)
+    mmap : bool
+        Memory-map arrays from raw shards instead of reading them into memory (default is True)
+    columns : numpy array
+        Sorted canonical positions to load from shards with the column layout, which only read the groups of 
+        columns containing these positions (default is None, loading all positions). Shards with the row 
+        layout always load all positions
+    packed : bool
+        Return the numberings of shards with the packed layout as packed_numberings instead of unpacking them (default is False)
+
+    Returns
+    -------
+    dict
+        Arrays in the shard
+    """
+
+    if not os.path.isdir(file):
+        with np.load(file, allow_pickle=True) as data: # Arrays are read from the npz file before it is closed
+            return _load_arrays(data.__getitem__, data.files, keys, columns, packed)
+
+    return _load_arrays(lambda key: _load_raw_array(os.path.join(file, f"{key}.npy"), mmap), _stored_keys(file), keys, columns, packed)
+
+
+def _load_arrays(load, available_keys, keys=None, columns=None, packed=False):
+
+    layout = _shard_layout(available_keys)
+    if keys is None: 
+        keys = [key for key in available_keys if key not in column_groups and key != 'packed_numberings'] + (['numberings'] if layout != 'rows' else [])
+
+    arrays = {key: load(key) for key in keys if key in available_keys}
+
+    if layout == 'columns' and 'numberings' in keys:
+        arrays['numberings'] = _load_columns(load, columns)
+    elif layout == 'packed' and 'numberings' in keys:
+        if packed:
+            arrays['packed_numberings'] = load('packed_numberings')
+        else:
+            arrays['numberings'] = unpack_numberings(load('packed_numberings'))
+
+    return arrays
+
+
+def _stored_keys(file):
+
+    if not os.path.isdir(file):
+        with np.load(file) as data: return data.files
+
+    return [os.path.basename(fname)[:-4] for fname in glob.glob(os.path.join(file, "*.npy"))]
+
+
+def _shard_layout(stored_keys):
+
+    if any(key in column_groups for key in stored_keys): return 'columns'
+    return 'packed' if 'packed_numberings' in stored_keys else 'rows'
+
+
+def _load_columns(load, columns=None):
+    """
+    Assemble the numberings of a shard with the column layout, only loading the groups of columns needed.
+    """
+
+    numberings = []
+    for key, group_columns in column_groups.items():
+        needed = np.ones(group_columns.shape[0], bool) if columns is None else np.isin(group_columns, columns)
+        if not needed.any(): continue
+
+        group = load(key)
+        numberings.append(np.asarray(group) if needed.all() else np.asarray(group)[:, needed])
+
+    return np.concatenate(numberings, axis=1)
+
+
+def _load_raw_array(file, mmap=True):
+
+    if mmap:
+        try:
+            return np.load(file, mmap_mode='r')
+        except ValueError:  # Arrays of python objects (unusual sequences) cannot be memory-mapped
+            pass
+
+    return np.load(file, allow_pickle=True)
+
+
+def remove_shard(file):
+
+    if os.path.isdir(file):
+        shutil.rmtree(file)
+    else:
+        os.remove(file)
+        
+    update_manifest(file, None)
+
+
+# Each folder of shards can have a manifest, summarising the sequences in each shard (e.g. the range of region lengths)
+manifest_name = 'manifest.json'
+
+
+def read_manifest(folder):
+    """
+    Read the manifest of a folder, returning an empty manifest if there is none.
+    """
+
+    manifest_file = os.path.join(folder, manifest_name)
+    if not os.path.exists(manifest_file): return {}
+
+    with open(manifest_file, "r") as handle:
+        return json.load(handle)
+
+
+def update_manifest(file, summary):
+    """
+    Add (or replace) the summary of a shard in the manifest of its folder. A summary of None removes the shard.
+    """
+
+    folder, name = os.path.split(file)
+    manifest = read_manifest(folder)
+
+    if summary is None:
+        if name not in manifest: return
+        manifest.pop(name)
+    else:
+        manifest[name] = summary
+
+    with open(os.path.join(folder, manifest_name), "w") as handle:
+        json.dump(manifest, handle, indent=1)
+
+
+def find_shards(folder, suffix='normal'):
+    """
+    Find all shards of a given type (normal or unusual) in folder, independent of their format.
+    """
+
+    return sorted(
+        glob.glob(os.path.join(folder, f"*data-subset-{suffix}-*.npz")) +
+        glob.glob(os.path.join(folder, f"*data-subset-{suffix}-*{raw_shard_extension}"))
+    )
+
+
+def convert_database(database_path, shard_format='npy', shard_layout='rows'):
+    """Convert all shards in an existing database to another format or layout, adding any missing indexes.
+
+    Parameters
+    ----------
+    database_path : str
+        Path to the database
+    shard_format : str
+        Format to convert the shards to (default is npy)
+    shard_layout : str
+        Layout to convert the shards to, either rows, columns or packed (default is rows)
+    """
+
+    for subfolder in glob.glob(os.path.join(database_path, '*', '*')):
+        for suffix in ['normal', 'unusual']:
+            for file in find_shards(subfolder, suffix):
+
+                stored_keys = _stored_keys(file)
+                data = load_shard(file, mmap=False)
+                data.pop('residue_ends', None) # No longer stored, as searches never used it
+                missing_index = suffix == 'normal' and not all(key in data for key in ['region_lengths', 'block_residues'])
+                same_layout = suffix != 'normal' or _shard_layout(stored_keys) == shard_layout
+                
+                if os.path.isdir(file) == (shard_format == 'npy') and same_layout and not missing_index: 
+                    if os.path.basename(file) not in read_manifest(subfolder): update_manifest(file, shard_summary(data))
+                    continue
+                
+                if missing_index: data.update(index_arrays(data['numberings']))
+
+                new_file = save_shard(subfolder, suffix, shard_format, shard_layout, **data)
+                update_manifest(new_file, shard_summary(data))
+                remove_shard(file)
@@ -0,0 +1,204 @@
+import numpy as np
+
+from kasearch.canonical_alignment import canonical_numbering, oas_numbering_finder
+from kasearch.identity_calculations import default_region_masks, default_length_matched
+
+# Unusual sequences have positions outside the canonical alignment, so they are compared as sets of
+# (position, residue) keys, as in slow_calculate_seq_id. Each key is encoded as a single integer:
+# the position number, its insertion code (0 for none, 1-26 for A-Z) and the residue (0-25 for A-Z, 31 for any other).
+_insertion_codes = 32
+_residue_codes = 32
+
+
+def label_code(label):
+    """
+    Integer code of a position, e.g. '111A'.
+    """
+
+    number, insertion = label[:-1], label[-1]
+    if insertion.isdigit(): number, insertion = label, ' '
+
+    return int(number) * _insertion_codes + (0 if insertion == ' ' else ord(insertion) - 64)
+
+
+def residue_code(residue):
+    return ord(residue) - 65 if 'A' <= residue <= 'Z' else _residue_codes - 1
+
+
+_canonical_label_codes = np.array([label_code(label) for label in canonical_numbering], np.int64)
+
+
+def numbering_keys(numbering):
+    """Keys of the residues in a sequence.
+
+    Parameters
+    ----------
+    numbering : str or list
+        Either OAS derived ANARCI numberings or ANARCI numberings, i.e. a list of ((number, insertion), residue)
+
+    Returns
+    -------
+    numpy array
+        Sorted unique keys of the residues in the sequence (gaps are skipped)
+    """
+
+    if isinstance(numbering, str):
+        residues = [(res[:-5], res[-1]) for res in oas_numbering_finder.findall(numbering)]
+    else:
+        residues = [(f"{num[0]}{num[1]}", res) for num, res in numbering]
+
+    return np.unique(np.array([
+        label_code(label) * _residue_codes + residue_code(res) for label, res in residues if res != '-'
+    ], np.int64))
+
+
+def sequence_keys(sequences):
+    """Keys of the residues in each unusual sequence.
+
+    Unusual sequences are stored as either OAS derived ANARCI numberings or as amino acid sequences,
+    which are numbered with ANARCI. Sequences which cannot be numbered have no keys.
+
+    Returns
+    -------
+    list of numpy arrays
+        Keys of each sequence
+    """
+
+    sequences = list(sequences)
+    is_numbered = [isinstance(seq, str) and seq.startswith('{') for seq in sequences]
+
+    numbered = [seq if numbered else None for seq, numbered in zip(sequences, is_numbered)]
+    to_number = [num for num, numbered in enumerate(is_numbered) if not numbered]
+
+    if to_number:
+        from kasearch.anarci_numbering import number_many_at_once
+
+        for num, numbering in zip(to_number, number_many_at_once([sequences[i] for i in to_number], strict=False)):
+            numbered[num] = numbering
+
+    return [numbering_keys(numbering) if numbering is not None else np.zeros(0, np.int64) for numbering in numbered]
+
+
+def canonical_keys(numberings):
+    """
+    Keys of the residues in canonically aligned sequences (e.g. queries), as a list of arrays.
+    """
+
+    numberings = np.asarray(numberings).astype(np.int64)
+    exists = (numberings != 0) & (numberings != 124)
+
+    residues = np.where((numberings >= 65) & (numberings <= 90), numberings - 65, _residue_codes - 1)
+    keys = _canonical_label_codes[None] * _residue_codes + residues
+
+    return [np.unique(seq_keys[seq_exists]) for seq_keys, seq_exists in zip(keys, exists)]
+
+
+def key_region_membership(keys, region_masks):
+    """Whether the position of each key is within each region.
+
+    A position is within a region if it is one of the canonical positions of the region or, for positions outside
+    the canonical alignment, if its number is the number of a canonical position in the region. All positions
+    are within a region covering the whole canonical alignment.
+
+    Returns
+    -------
+    numpy array
+        Boolean array of shape (keys, regions)
+    """
+
+    labels = keys // _residue_codes
+    is_canonical = np.isin(labels, _canonical_label_codes)
+
+    membership = []
+    for mask in np.asarray(region_masks, dtype=bool):
+        if mask.all():
+            membership.append(np.ones(labels.shape, bool))
+            continue
+
+        region_labels = _canonical_label_codes[mask]
+        membership.append(np.where(
+            is_canonical, np.isin(labels, region_labels), np.isin(labels // _insertion_codes, region_labels // _insertion_codes)
+        ))
+
+    return np.stack(membership, axis=-1)
+
+
+def concatenate_keys(list_of_keys):
+    """
+    Concatenated keys of many sequences, with the index of the sequence each key belongs to.
+    """
+
+    lengths = np.array([keys.shape[0] for keys in list_of_keys], np.int64)
+    keys = np.concatenate(list_of_keys) if list_of_keys else np.zeros(0, np.int64)
+
+    return keys, np.repeat(np.arange(len(list_of_keys)), lengths)
+
+
+def calculate_unusual_identities(query_keys, target_keys, target_sequence, n_targets, region_masks, length_matched):
+    """Identities between queries and targets, using the key sets of each sequence.
+
+    The identities of a region are the overlap averaged over the length of both sequences, as in slow_calculate_seq_id,
+    and zero if either sequence has no residues in the region. Length matched regions are zero for sequences
+    of different lengths.
+
+    Parameters
+    ----------
+    query_keys : list of numpy arrays
+        Keys of each query (see canonical_keys)
+    target_keys : numpy array
+        Concatenated keys of the targets (see concatenate_keys)
+    target_sequence : numpy array
+        Index of the target each key belongs to
+    n_targets : int
+        Number of targets
+
+    Returns
+    -------
+    numpy array
+        Identities of shape (targets, queries, regions)
+    """
+
+    target_membership = key_region_membership(target_keys, region_masks)
+    target_lengths = np.stack([
+        np.bincount(target_sequence, weights=target_membership[:, num], minlength=n_targets) for num in range(len(region_masks))
+    ], axis=-1)
+
+    identities = np.zeros((n_targets, len(query_keys), len(region_masks)), np.float32)
+
+    for num_query, keys in enumerate(query_keys):
+        query_lengths = key_region_membership(keys, region_masks).sum(0)
+        overlapping = np.isin(target_keys, keys)
+
+        overlap = np.stack([
+            np.bincount(target_sequence[overlapping], weights=target_membership[overlapping, num], minlength=n_targets)
+            for num in range(len(region_masks))
+        ], axis=-1)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            query_identities = (overlap / query_lengths + overlap / target_lengths) / 2
+
+        valid = (query_lengths > 0) & (target_lengths > 0) & (~np.asarray(length_matched) | (query_lengths == target_lengths))
+        identities[:, num_query] = np.where(valid, query_identities, 0)
+
+    return identities
+
+
+def get_n_most_identical_unusual(
+    query, target_keys, target_sequence, target_ids, n=10,
+    region_masks=default_region_masks,
+    length_matched=default_length_matched,
+):
+    """
+    Find the n most identical unusual sequences for each query and region. The output has the
+    same shapes as get_n_most_identical_multiquery.
+    """
+
+    n_targets = target_ids.shape[0]
+    identities = calculate_unusual_identities(canonical_keys(query), target_keys, target_sequence, n_targets, region_masks, length_matched)
+
+    position_of_n_best = np.argsort(-identities, axis=0, kind='stable')[:n]
+
+    n_highest_identities = np.take_along_axis(identities, position_of_n_best, axis=0)
+    n_highest_ids = np.asarray(target_ids)[position_of_n_best]
+
+    return n_highest_identities.transpose((1,0,2)), n_highest_ids.transpose((1,0,2,3))
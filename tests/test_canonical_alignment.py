@@ -0,0 +1,74 @@
+import numpy as np
+
+from kasearch.canonical_alignment import canonical_alignment_oas, canonical_alignment_oas_many, canonical_numbering, canonical_numbering_len
+
+
+def _oas_numbering(positions, residues):
+    """
+    OAS style ANARCI numbering, i.e. the text of a dictionary of the residue at each position.
+    """
+
+    return "{'fwh1': {" + ', '.join(f"'{position}': '{residue}'" for position, residue in zip(positions, residues)) + "}}"
+
+
+def _numberings(rng, n):
+    numberings = []
+    for _ in range(n):
+        start = rng.integers(0, 20)
+        stop = rng.integers(canonical_numbering_len - 20, canonical_numbering_len + 1)
+        positions = [canonical_numbering[i] for i in range(start, stop) if rng.random() < 0.7]
+        numberings.append(_oas_numbering(positions, rng.choice(list('ACDEFGHIKLMNPQRSTVWY'), len(positions))))
+    return numberings
+
+
+def _aligned_one_by_one(numberings):
+    sequences, failed = np.zeros((len(numberings), canonical_numbering_len), np.int8), np.zeros(len(numberings), bool)
+    for num, numbering in enumerate(numberings):
+        try:
+            sequences[num] = canonical_alignment_oas(numbering)
+        except Exception:
+            failed[num] = True
+    return sequences, failed
+
+
+def test_batched_oas_alignment_matches_aligning_one_by_one():
+    numberings = _numberings(np.random.default_rng(0), 200)
+
+    sequences, failed = canonical_alignment_oas_many(numberings)
+    expected_sequences, expected_failed = _aligned_one_by_one(numberings)
+
+    assert not failed.any()
+    assert np.array_equal(sequences, expected_sequences)
+
+
+def test_batched_oas_alignment_matches_aligning_one_by_one_for_unusual_numberings():
+    valid = _numberings(np.random.default_rng(1), 3)
+
+    numberings = [
+        valid[0],
+        None, # Failed numbering
+        "{}", # No residues
+        "{'fwh1': {}}",
+        _oas_numbering(['1 ', '2 ', '999 ', '4 '], 'QVQL'), # Position outside the canonical alignment
+        _oas_numbering(['1 ', '2 ', '111Z', '4 '], 'QVQL'), # Insertion outside the canonical alignment
+        _oas_numbering(['1 ', '02 ', '3 '], 'QVQ'), # Leading zero
+        _oas_numbering(['1 ', '1111 ', '3 '], 'QVQ'), # Four digits
+        _oas_numbering(['1 ', '2 ', '2 ', '3 '], 'QVEL'), # Repeated position, where the later residue is kept
+        _oas_numbering(['5 ', '3 ', '7 ', '6 '], 'QVQL'), # Positions out of order
+        _oas_numbering(['1 ', '2 ', '3 '], 'Q-L'), # Gap
+        _oas_numbering(['1 ', '2 ', '3 '], 'QvL'), # Lower case residue
+        _oas_numbering(['1 ', '2 ', '3 '], 'XBZ'), # Unusual residues
+        valid[1].replace(', ', ',\n', 1), # Line break, aligned separately
+        valid[2].replace("}}", "}, 'note': 'é'}}"), # Not ascii, aligned separately
+        _oas_numbering(['1 ', '2 '], 'QV') + "\n" + _oas_numbering(['3 '], 'L'),
+        "{'fwh1': {'1 ': 'Q', '2 ': 'V'}, 'cdrh3': {'111A': 'A', '111B': 'R', '112B': 'D'}}",
+        "no numbering at all",
+        valid[0],
+    ]
+
+    sequences, failed = canonical_alignment_oas_many(numberings)
+    expected_sequences, expected_failed = _aligned_one_by_one(numberings)
+
+    assert np.array_equal(failed, expected_failed)
+    assert np.array_equal(sequences, expected_sequences)
+    assert not failed[[0, 8, 9, 13, 14, 18]].any() and failed[[1, 2, 3, 4, 5, 6, 7]].all()
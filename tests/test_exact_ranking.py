@@ -0,0 +1,86 @@
+import os
+
+import numpy as np
+import pytest
+
+from kasearch.kasearch import SearchDB
+from kasearch.shard_io import save_shard
+from kasearch.region_index import index_arrays
+
+n_sequences = 3000
+
+
+def _numberings(rng, n):
+    numberings = rng.choice(np.frombuffer(b'ACDEFGHIKLMNPQRSTVWY', np.int8), size=(n, 200))
+    numberings[rng.random((n, 200)) < 0.3] = 0
+    numberings[:, :2], numberings[:, -2:] = 124, 124
+    return numberings.astype(np.int8)
+
+
+def _tied_sequences():
+    """
+    Sequences which are copies of a few variants of the queries, so many have the same identities, with shuffled ids.
+    """
+
+    rng = np.random.default_rng(0)
+    queries = _numberings(rng, 3)
+
+    variants = np.repeat(queries, 4, axis=0) # Four variants of each query, with increasingly many positions changed
+    mutated = rng.random(variants.shape) < np.tile([0, 0.05, 0.2, 0.5], 3)[:, None]
+    variants[mutated & (variants != 124)] = 65
+
+    numberings = variants[rng.integers(0, variants.shape[0], n_sequences)]
+    idxs = np.stack([rng.integers(0, 3, n_sequences), rng.permutation(n_sequences)], axis=-1).astype(np.int32)
+
+    return queries, numberings, idxs
+
+
+def _database(path, shard_format, shard_layout, n_shards):
+    _, numberings, idxs = _tied_sequences()
+    folder = os.path.join(path, 'Heavy', 'Human')
+    os.makedirs(folder)
+
+    order = np.random.default_rng(n_shards).permutation(n_sequences) # Each split stores the sequences in a different order
+    for shard in np.array_split(order, n_shards):
+        save_shard(folder, 'normal', shard_format, shard_layout, numberings=numberings[shard], idxs=idxs[shard], **index_arrays(numberings[shard]))
+
+    with open(os.path.join(path, 'id_to_study.txt'), 'w') as handle:
+        handle.write(str({0: 'study_0.csv', 1: 'study_1.csv', 2: 'study_2.csv'}))
+
+    return path
+
+
+def _exact_search(database_path, backend):
+    queries = _tied_sequences()[0]
+
+    with SearchDB(database_path, backend=backend, exact_ranking=True, compilation_cache_dir=False) as searchdb:
+        searchdb.search(queries, keep_best_n=600) # Past the copies of the first variants
+        return searchdb.current_best_keys, searchdb.current_best_ids
+
+
+@pytest.fixture(scope='module')
+def reference(tmp_path_factory):
+    return _exact_search(_database(str(tmp_path_factory.mktemp('reference')), 'npz', 'rows', 1), 'numpy')
+
+
+@pytest.mark.parametrize('backend', ['numpy', 'jax'])
+@pytest.mark.parametrize('shard_format, shard_layout, n_shards', [
+    ('npz', 'rows', 1), ('npz', 'rows', 3), ('npz', 'columns', 2), ('npy', 'rows', 3), ('npy', 'columns', 1), ('npy', 'packed', 3),
+])
+def test_exact_ranking_is_identical_across_backends_layouts_and_splits(tmp_path, reference, backend, shard_format, shard_layout, n_shards):
+    reference_keys, reference_ids = reference
+    keys, ids = _exact_search(_database(str(tmp_path), shard_format, shard_layout, n_shards), backend)
+
+    assert np.array_equal(keys, reference_keys)
+    assert np.array_equal(ids, reference_ids)
+
+
+def test_exact_ranking_ranks_ties_by_id(reference):
+    keys, ids = reference
+
+    assert (keys[:, :-1] >= keys[:, 1:]).all()
+    assert (keys[:, :-1] == keys[:, 1:]).any(1).all() # Every query and region has ties
+
+    tied = keys[:, :-1] == keys[:, 1:]
+    id_order = (ids[:, :-1, :, 0] < ids[:, 1:, :, 0]) | ((ids[:, :-1, :, 0] == ids[:, 1:, :, 0]) & (ids[:, :-1, :, 1] < ids[:, 1:, :, 1]))
+    assert id_order[tied].all()
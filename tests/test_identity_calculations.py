@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+from kasearch.identity_calculations import tile_targets, bucketed_size, get_n_most_identical_multiquery, default_region_masks
+from kasearch.jax_identity import calculate_seq_ids_multiquery
+
+
+def _numberings(rng, n, base=None, mutation_rate=0.3):
+    numberings = rng.choice(np.frombuffer(b'ACDEFGHIKLMNPQRSTVWY', np.int8), size=(n, 200))
+    if base is not None: numberings = np.where(rng.random((n, 200)) < mutation_rate, numberings, base)
+    numberings[rng.random((n, 200)) < 0.2] = 0
+    numberings[:, :rng.integers(0, 5)], numberings[:, 200 - rng.integers(1, 5):] = 124, 124
+    return numberings.astype(np.int8)
+
+
+@pytest.mark.parametrize('n_devices', [1, 2, 8, 30, 62, 64])
+@pytest.mark.parametrize('n_rows', [1 << 18, 1_000_000, 2_500_000, 5_000_000, 5_000_000 - 1234])
+def test_tile_padding_is_bounded_by_bucketed_size(n_rows, n_devices):
+    tile_size = 4096
+    targets = np.zeros((n_rows, 1), np.int8) # A single position, as only the number of rows matters
+
+    tiles, first_rows = tile_targets(targets, n_devices, tile_size)
+
+    needed_tiles = -(-n_rows // (n_devices * tile_size))
+    assert tiles.shape == (n_devices, bucketed_size(needed_tiles), tile_size, 1)
+    assert tiles.shape[1] <= needed_tiles * (1 + 1 / 8)
+    assert np.array_equal(first_rows, np.arange(n_devices) * tiles.shape[1] * tile_size)
+
+
+def test_small_targets_share_tile_shapes():
+    shapes = {tile_targets(np.zeros((n_rows, 1), np.int8), 1)[0].shape for n_rows in range(1, 1 << 18, 997)}
+    assert len(shapes) <= 7
+
+
+@pytest.mark.parametrize('length_matched', [[False, False, False], [False, True, True], [True, True, True]])
+@pytest.mark.parametrize('include_ends', [True, False])
+def test_numpy_backend_finds_the_same_most_identical_targets_as_jax(length_matched, include_ends):
+    rng = np.random.default_rng(0)
+    queries = _numberings(rng, 5)
+    targets = np.concatenate([_numberings(rng, 3000, base=queries[num], mutation_rate=0.6) for num in range(3)] + [_numberings(rng, 1000)])
+    target_ids = np.stack([np.arange(targets.shape[0]) % 2, np.arange(targets.shape[0])], axis=-1).astype(np.int32)
+    options = dict(n=20, region_masks=default_region_masks, length_matched=np.array(length_matched), include_ends=include_ends)
+
+    jax_identities, jax_ids = get_n_most_identical_multiquery(queries, targets, target_ids, backend='jax', **options)
+    numpy_identities, numpy_ids = get_n_most_identical_multiquery(queries, targets, target_ids, backend='numpy', **options)
+
+    assert np.array_equal(numpy_identities, jax_identities)
+
+    # Targets with the same identity can be returned in any order, so only those above the lowest identity returned are compared
+    identities = np.nan_to_num(calculate_seq_ids_multiquery(targets, queries, default_region_masks, np.array(length_matched), include_ends))
+    for query in range(queries.shape[0]):
+        for region in range(default_region_masks.shape[0]):
+            lowest = jax_identities[query, -1, region]
+            above = jax_identities[query, :, region] > lowest
+
+            assert set(map(tuple, numpy_ids[query, above, region])) == set(map(tuple, jax_ids[query, above, region]))
+            assert np.array_equal(identities[numpy_ids[query, :, region, 1], query, region], numpy_identities[query, :, region])
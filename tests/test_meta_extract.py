@@ -0,0 +1,63 @@
+import os
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from kasearch.kasearch import SearchDB
+from kasearch.shard_io import save_shard
+from kasearch.region_index import index_arrays
+
+
+def _numberings(rng, n):
+    numberings = rng.choice(np.frombuffer(b'ACDEFGHIKLMNPQRSTVWY', np.int8), size=(n, 200))
+    numberings[:, :2], numberings[:, -2:] = 124, 124
+    return numberings.astype(np.int8)
+
+
+@pytest.fixture
+def study_database(tmp_path):
+    """
+    Database of three studies, where every sequence on an even line is identical to the query.
+    """
+
+    rng = np.random.default_rng(0)
+    folder = tmp_path / 'Heavy' / 'Human'
+    os.makedirs(folder)
+    os.makedirs(tmp_path / 'extra_data')
+
+    query, n_sequences, id_to_study = _numberings(rng, 1), 40, {}
+    for study_id in range(3):
+        numberings = _numberings(rng, n_sequences)
+        numberings[::2] = query
+        idxs = np.stack([np.full(n_sequences, study_id), np.arange(n_sequences)], axis=-1).astype(np.int32)
+        save_shard(str(folder), 'normal', 'npz', numberings=numberings, idxs=idxs, **index_arrays(numberings))
+
+        # OAS style study file, with the meta data of the study on the first line
+        id_to_study[study_id] = study_file = f'study_{study_id}.csv'
+        pd.Series(name=json.dumps({'Species': 'Human', 'Study': study_id}), dtype=object).to_csv(tmp_path / 'extra_data' / study_file, index=False)
+        pd.DataFrame({'sequence': [f'S{study_id}_{line}' for line in range(n_sequences)]}).to_csv(tmp_path / 'extra_data' / study_file, index=False, mode='a')
+
+    with open(tmp_path / 'id_to_study.txt', 'w') as handle:
+        handle.write(str(id_to_study))
+
+    return str(tmp_path), query
+
+
+def test_meta_cache_stats_count_each_study_once(study_database):
+    database_path, query = study_database
+
+    with SearchDB(database_path, backend='numpy', regions=['whole'], length_matched=[False]) as searchdb:
+        searchdb.search(query, keep_best_n=60) # All 60 identical sequences, 20 from each study
+
+        meta = searchdb.get_meta_all()[0][0]
+        assert sorted(meta['sequence']) == sorted(f'S{study_id}_{line}' for study_id in range(3) for line in range(0, 40, 2))
+        assert searchdb.meta_cache_stats['studies']['misses'] == 3
+        assert searchdb.meta_cache_stats['studies']['hits'] == 0
+        assert searchdb.meta_cache_stats['rows']['misses'] == 60
+
+        searchdb.get_meta_all()
+        assert searchdb.meta_cache_stats['studies']['misses'] == 3
+        assert searchdb.meta_cache_stats['studies']['hits'] == 3
+        assert searchdb.meta_cache_stats['rows']['hits'] == 60
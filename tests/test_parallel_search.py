@@ -0,0 +1,62 @@
+import os
+
+import numpy as np
+import pytest
+
+import kasearch.kasearch
+from kasearch.kasearch import SearchDB
+from kasearch.shard_io import save_shard
+from kasearch.region_index import index_arrays, summary_block_size
+from kasearch.identity_calculations import identity_key_bits
+
+
+def _numberings(rng, n):
+    numberings = rng.choice(np.frombuffer(b'ACDEFGHIKLMNPQRSTVWY', np.int8), size=(n, 200))
+    numberings[rng.random((n, 200)) < 0.3] = 0
+    numberings[:, :2], numberings[:, -2:] = 124, 124
+    return numberings.astype(np.int8)
+
+
+@pytest.fixture
+def tied_database(tmp_path):
+    """
+    Database where all sequences but those on every 7th line are identical to the query, with ids decreasing with their row.
+    """
+
+    rng = np.random.default_rng(0)
+    folder = tmp_path / 'Heavy' / 'Human'
+    os.makedirs(folder)
+
+    query = _numberings(rng, 1)
+    for file_id, (n_sequences, shard_format) in enumerate([(5 * summary_block_size + 100, 'npy'), (3000, 'npz')]):
+        lines = np.arange(n_sequences)[::-1]
+        numberings = np.repeat(query, n_sequences, axis=0)
+        numberings[lines % 7 == 3] = _numberings(rng, (lines % 7 == 3).sum())
+        idxs = np.stack([np.full(n_sequences, file_id), lines], axis=-1).astype(np.int32)
+        save_shard(str(folder), 'normal', shard_format, numberings=numberings, idxs=idxs, **index_arrays(numberings))
+
+    with open(tmp_path / 'id_to_study.txt', 'w') as handle:
+        handle.write(str({0: 'study_0.csv', 1: 'study_1.csv'}))
+
+    return str(tmp_path), query
+
+
+@pytest.mark.parametrize('regions, length_matched', [(['whole', 'cdrs', 'cdr3'], [False, True, True]), (['cdr3'], [True])])
+def test_parallel_search_matches_serial_search(tied_database, monkeypatch, regions, length_matched):
+    database_path, query = tied_database
+    monkeypatch.setattr(kasearch.kasearch, 'scan_unit_rows', 2 * summary_block_size) # The npy shard is split into 3 units
+
+    with SearchDB(database_path, backend='numpy', regions=regions, length_matched=length_matched, exact_ranking=True) as searchdb:
+        searchdb.search(query, keep_best_n=25)
+        serial_keys, serial_ids = searchdb.current_best_keys, searchdb.current_best_ids
+
+        searchdb.search(query, keep_best_n=25, n_workers=2)
+
+        assert np.array_equal(searchdb.current_best_keys, serial_keys)
+        assert np.array_equal(searchdb.current_best_ids, serial_ids)
+
+    # All 25 are exact matches, ranked by id
+    lines = np.arange(100)
+    assert (serial_keys == 1 << identity_key_bits).all()
+    assert (serial_ids[..., 0] == 0).all()
+    assert np.array_equal(serial_ids[0, :, 0, 1], lines[lines % 7 != 3][:25])